@@ -1,33 +1,65 @@
+import logging
 from flask import Flask
-from flasgger import Swagger
 from core.models import db
+from core.bulkhead import init_bulkheads
+from core.database import configure_database
 from core.config import *
-from core.util import before_request, after_request, handle_error
+from core.hashing import HashingBusy, shutdown_hash_pool
+from core.mailer import init_mailer, mail_sender
+from core.migrations import migrate_command
+from core.util import before_request, after_request, handle_error, handle_service_unavailable
 from services.auth import auth_bp
-from services.reports import reports_bp
+from services.reports import reports_bp, shutdown_report_workers
 from services.health import health_bp
 from services.metrics import metrics_bp
 from services.mock import mock_bp
 from services.fault_demo import fault_demo_bp
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 
-app = Flask(__name__)
-CORS(app)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_URI}/{DB_NAME}'
-app.register_blueprint(auth_bp)
-app.register_blueprint(reports_bp)
-app.register_blueprint(health_bp)
-app.register_blueprint(metrics_bp)
-app.register_blueprint(mock_bp)
-app.register_blueprint(fault_demo_bp)
+def create_app():
+    app = Flask(__name__)
+    if TRUSTED_PROXY_HOPS:
+        # remote_addr becomes the client address the ingress saw, not the ingress itself
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS,
+                                x_host=TRUSTED_PROXY_HOPS)
+    CORS(app)
 
-app.before_request(before_request)
-app.after_request(after_request)
-app.errorhandler(Exception)(handle_error)
+    configure_database(app, f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_URI}/{DB_NAME}', DB_REPLICA_URI)
+    app.register_blueprint(auth_bp)
+    app.register_blueprint(reports_bp)
+    app.register_blueprint(health_bp)
+    app.register_blueprint(metrics_bp)
+    app.register_blueprint(mock_bp)
+    app.register_blueprint(fault_demo_bp)
 
-swagger = Swagger(app)
-db.init_app(app)
+    app.before_request(before_request)
+    init_bulkheads(app)
+    app.after_request(after_request)
+    app.errorhandler(Exception)(handle_error)
+    app.errorhandler(HashingBusy)(lambda _: handle_service_unavailable())
+
+    if ENABLE_SWAGGER:
+        # flasgger pulls in jsonschema, yaml and mistune, skip the import when the docs are off
+        from flasgger import Swagger
+        Swagger(app)
+    db.init_app(app)
+    init_mailer(app)
+    app.cli.add_command(migrate_command)
+    return app
+
+
+def shutdown():
+    """Stops the background workers and flushes queued log records, called when a server worker exits."""
+    mail_sender.stop()
+    shutdown_report_workers()
+    shutdown_hash_pool()
+    logging.shutdown()
+
+
+app = create_app()
 
 if __name__ == '__main__':
-    app.run(debug=True, host="0.0.0.0", port=5000)
+    mail_sender.start()
+    app.run(debug=bool(IS_DEV), host="0.0.0.0", port=5000)
@@ -0,0 +1,92 @@
+"""
+Report query latency on a seeded events table before and after the events indexes.
+
+Seeds users x events_per_user events (2M by default) into a scratch sqlite file, or into the
+database at DATABASE_URI - its events and users tables are dropped and recreated.
+
+Usage: python -m benchmarks.event_indexes [users] [events_per_user] [samples]
+"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from flask import Flask
+from sqlalchemy import insert, text
+from core.migrations import MIGRATIONS
+from core.models import db, Event, User
+from core.queries import events_fingerprint, hours_by_event_type, monthly_event_rows
+
+SINCE = datetime(2024, 6, 1)
+INDEX_MIGRATIONS = [migration for version, _, migration in MIGRATIONS if version in (4, 5)]
+
+
+def seed(users, events_per_user, batch_size=50_000):
+    # only the benchmarked tables, the rest of a real database (outbox, migrations...) is left alone
+    tables = [Event.__table__, User.__table__]
+    db.metadata.drop_all(db.engine, tables=tables)
+    db.metadata.create_all(db.engine, tables=tables)
+    with db.engine.begin() as connection:
+        for index in Event.__table__.indexes:
+            connection.execute(text(f'DROP INDEX {index.name}'))
+        connection.execute(insert(User), [{'id': i, 'gmail': f'user{i}@test.com', 'password': 'x'}
+                                          for i in range(1, users + 1)])
+
+        # events of all users interleave the way they are clocked in, ids follow insertion order
+        start = SINCE - timedelta(days=events_per_user - 60)
+        batch = []
+        for day in range(events_per_user):
+            for user_id in range(1, users + 1):
+                begins = start + timedelta(days=day, hours=8)
+                batch.append({'user_id': user_id, 'event_type_id': day % 5 + 1, 'start_date': begins,
+                              'end_date': begins + timedelta(hours=8),
+                              'previous_event_id': (day - 1) * users + user_id if day else None})
+                if len(batch) == batch_size:
+                    connection.execute(insert(Event), batch)
+                    batch = []
+        if batch:
+            connection.execute(insert(Event), batch)
+
+
+def measure(users, samples):
+    timings = {'monthly_event_rows': [], 'hours_by_event_type': [], 'events_fingerprint': []}
+    for _ in range(samples):
+        user_id = random.randint(1, users)
+        for name, query in (('monthly_event_rows', monthly_event_rows), ('hours_by_event_type', hours_by_event_type),
+                            ('events_fingerprint', events_fingerprint)):
+            started = time.perf_counter()
+            query(user_id, SINCE)
+            timings[name].append((time.perf_counter() - started) * 1000)
+        db.session.remove()
+    return {name: statistics.median(values) for name, values in timings.items()}
+
+
+def main(users=1000, events_per_user=2000, samples=20):
+    with tempfile.TemporaryDirectory() as directory:
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+            'DATABASE_URI', f'sqlite:///{os.path.join(directory, "events.db")}')
+        db.init_app(app)
+        with app.app_context():
+            started = time.perf_counter()
+            seed(users, events_per_user)
+            print(f'seeded {users * events_per_user:,} events on {db.engine.dialect.name} '
+                  f'in {time.perf_counter() - started:.1f}s')
+
+            before = measure(users, samples)
+            started = time.perf_counter()
+            for migration in INDEX_MIGRATIONS:
+                migration(db.engine)
+            print(f'indexes built in {time.perf_counter() - started:.1f}s')
+            after = measure(users, samples)
+
+            print(f'{"query":<22}{"before ms":>12}{"after ms":>12}')
+            for name in before:
+                print(f'{name:<22}{before[name]:>12.2f}{after[name]:>12.2f}')
+            db.engine.dispose()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:4]))
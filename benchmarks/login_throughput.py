@@ -0,0 +1,55 @@
+"""
+Login throughput of bcrypt verification inline on request threads vs the core.hashing process pool.
+
+Usage: python -m benchmarks.login_throughput [clients] [seconds]
+"""
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import core.hashing as hashing
+
+PASSWORD = 'kangaroollamaotter'
+
+
+def measure(check, clients, seconds):
+    done = []
+    deadline = time.perf_counter() + seconds
+
+    def client():
+        count = 0
+        while time.perf_counter() < deadline:
+            check()
+            count += 1
+        done.append(count)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(done) / seconds
+
+
+def main(clients=16, seconds=5):
+    pw_hash = hashing._hash(PASSWORD, hashing.BCRYPT_LOG_ROUNDS)
+    print(f'bcrypt rounds {hashing.BCRYPT_LOG_ROUNDS}, {clients} clients, {os.cpu_count()} cores')
+
+    rate = measure(lambda: hashing._check(pw_hash, PASSWORD), clients, seconds)
+    print(f'{"inline":<12}{rate:>10.1f} logins/s')
+
+    workers = 1
+    while workers <= (os.cpu_count() or 1):
+        hashing.shutdown_hash_pool()
+        hashing.hash_pool = ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'))
+        hashing.check_password(pw_hash, PASSWORD)  # warm up the workers
+        rate = measure(lambda: hashing.check_password(pw_hash, PASSWORD), clients, seconds)
+        print(f'{f"pool x{workers}":<12}{rate:>10.1f} logins/s')
+        workers *= 2
+    hashing.shutdown_hash_pool()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
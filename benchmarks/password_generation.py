@@ -0,0 +1,39 @@
+"""
+Registrations per second limited by password generation: bundled word list vs the old gist download.
+
+Usage: python -m benchmarks.password_generation [seconds]
+"""
+import sys
+import time
+import random
+import requests
+from core.util import generate_random_pass
+
+GIST_URL = 'https://gist.githubusercontent.com/borlaym/585e2e09dd6abd9b0d0a/raw/6e46db8f5c27cb18fd1dfa50c7c921a0fbacbad0/animals.json'
+
+
+def gist_random_pass():
+    response = requests.get(GIST_URL, timeout=5)
+    response.raise_for_status()
+    return ''.join(random.sample(response.json(), 3)).replace(' ', '')
+
+
+def rate(generate, seconds):
+    count = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        generate()
+        count += 1
+    return count / seconds
+
+
+def main(seconds=3):
+    print(f'{"local word list":<18}{rate(generate_random_pass, seconds):>14.1f} passwords/s')
+    try:
+        print(f'{"gist download":<18}{rate(gist_random_pass, seconds):>14.1f} passwords/s')
+    except requests.RequestException as ex:
+        print(f'{"gist download":<18}  skipped: {type(ex).__name__}')
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 3)
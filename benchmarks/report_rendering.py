@@ -0,0 +1,47 @@
+"""
+Compares report renderers on synthetic months of 10, 1k and 10k events.
+
+Usage: python -m benchmarks.report_rendering [repeats]
+"""
+import resource
+import sys
+import time
+from datetime import datetime, timedelta
+from core.renderer import RENDERERS
+
+SIZES = [10, 1_000, 10_000]
+EVENT_TYPES = ['Work', 'Sick leave', 'Vacation', 'Remote work', 'Overtime']
+
+
+def make_rows(count):
+    start = datetime(2024, 1, 1, 8)
+    return [(EVENT_TYPES[i % len(EVENT_TYPES)],
+             start + timedelta(hours=i), start + timedelta(hours=i + 1)) for i in range(count)]
+
+
+def run(renderer, rows, repeats):
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        pdf = renderer.monthly_events(rows)
+        timings.append(time.perf_counter() - started)
+    return min(timings), len(pdf)
+
+
+def main(repeats=3):
+    print(f'{"renderer":<10}{"events":>8}{"best ms":>12}{"size kB":>10}{"child rss MB":>14}')
+    for name, factory in RENDERERS.items():
+        renderer = factory()
+        for size in SIZES:
+            rows = make_rows(size)
+            try:
+                best, pdf_size = run(renderer, rows, repeats)
+            except OSError as ex:
+                print(f'{name:<10}{size:>8}  skipped: {str(ex).splitlines()[0]}')
+                break
+            child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+            print(f'{name:<10}{size:>8}{best * 1000:>12.1f}{pdf_size / 1024:>10.1f}{child_rss:>14.1f}')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
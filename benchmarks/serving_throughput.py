@@ -0,0 +1,76 @@
+"""
+Requests per second served by gunicorn (gunicorn.conf.py) across worker counts.
+
+Clients are separate processes with keep-alive connections hitting a token protected endpoint.
+Runs with IS_DEV set, so no database or Elasticsearch is needed.
+
+Usage: python -m benchmarks.serving_throughput [clients] [seconds] [workers ...]
+"""
+import http.client
+import os
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from core.tokens import generate_token
+
+HOST = '127.0.0.1'
+PORT = 5091
+PATH = '/v1/mock/token-test'
+
+
+def client(token, seconds):
+    connection = http.client.HTTPConnection(HOST, PORT, timeout=10)
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        connection.request('GET', PATH, headers={'Authorization': f'Bearer {token}'})
+        connection.getresponse().read()
+        latencies.append(time.perf_counter() - started)
+    connection.close()
+    return latencies
+
+
+def wait_until_ready(timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection(HOST, PORT, timeout=1)
+            connection.request('GET', '/v1/health/ready')
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(.2)
+    raise RuntimeError('gunicorn did not start')
+
+
+def run(workers, threads, clients, seconds):
+    env = {**os.environ, 'IS_DEV': '1', 'GUNICORN_WORKERS': str(workers), 'GUNICORN_THREADS': str(threads),
+           'GUNICORN_BIND': f'{HOST}:{PORT}', 'PROMETHEUS_MULTIPROC_DIR': f'/tmp/workclock-benchmark-{PORT}'}
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_ready()
+        token = generate_token(user_id=1, is_admin=False)
+        with ProcessPoolExecutor(clients) as pool:
+            results = list(pool.map(client, [token] * clients, [seconds] * clients))
+        latencies = sorted(latency for result in results for latency in result)
+        return len(latencies) / seconds, statistics.median(latencies), latencies[int(len(latencies) * .99)]
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(clients=16, seconds=5, *worker_counts):
+    print(f'{clients} clients, {os.cpu_count()} cores')
+    print(f'{"workers":>8}{"threads":>9}{"req/s":>10}{"p50 ms":>9}{"p99 ms":>9}')
+    for workers in worker_counts or (1, 2, 4, 8):
+        for threads in (1, 4):
+            rate, p50, p99 = run(workers, threads, clients, seconds)
+            print(f'{workers:>8}{threads:>9}{rate:>10.0f}{p50 * 1000:>9.2f}{p99 * 1000:>9.2f}')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
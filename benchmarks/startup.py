@@ -0,0 +1,42 @@
+"""
+Cold start of the app: import time and time to the first served request, with Swagger on and off.
+Every sample is a fresh interpreter.
+
+Usage: python -m benchmarks.startup [samples]
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PROBE = '''
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+response = app.app.test_client().get('/v1/health/ready')
+assert response.status_code == 200
+served = time.perf_counter()
+print(json.dumps({'import': imported - started, 'first_request': served - started}))
+'''
+
+
+def sample(env):
+    output = subprocess.run([sys.executable, '-c', PROBE], env={**os.environ, **env}, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main(samples=5):
+    print(f'{"configuration":<28}{"import ms":>12}{"first request ms":>18}')
+    for name, env in (('swagger on', {'ENABLE_SWAGGER': 'true'}),
+                      ('swagger off', {'ENABLE_SWAGGER': 'false'})):
+        results = [sample(env) for _ in range(samples)]
+        imported = statistics.median(result['import'] for result in results) * 1000
+        first_request = statistics.median(result['first_request'] for result in results) * 1000
+        print(f'{name:<28}{imported:>12.0f}{first_request:>18.0f}')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,38 @@
+"""
+Overhead of the validate_token decorator per request with and without the verified token cache.
+
+Usage: python -m benchmarks.token_validation [iterations]
+"""
+import sys
+import time
+from flask import Flask
+from unittest import mock
+import core.tokens as tokens
+from core.cache import TTLCache
+
+
+@tokens.validate_token()
+def handler(user_id):
+    return user_id
+
+
+def measure(app, headers, iterations):
+    with app.test_request_context(headers=headers):
+        handler()  # warm up
+        started = time.perf_counter()
+        for _ in range(iterations):
+            handler()
+        return (time.perf_counter() - started) / iterations * 1e6
+
+
+def main(iterations=50000):
+    app = Flask(__name__)
+    headers = {'Authorization': f'Bearer {tokens.generate_token(user_id=1, is_admin=False)}'}
+
+    with mock.patch.object(tokens, 'token_cache', TTLCache('benchmark_uncached', 0, maxsize=0)):
+        print(f'{"uncached":<10}{measure(app, headers, iterations):>8.2f} us/call')
+    print(f'{"cached":<10}{measure(app, headers, iterations):>8.2f} us/call')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,140 @@
+import time
+from flask import g, has_request_context, jsonify, request
+from prometheus_client import Counter, Gauge
+from sqlalchemy.exc import OperationalError
+from threading import BoundedSemaphore
+from core.config import *
+from core.util import handle_error
+
+bulkhead_inflight_gauge = Gauge('bulkhead_inflight', 'Requests in flight per bulkhead', ['bulkhead'],
+                                multiprocess_mode='livesum')
+bulkhead_capacity_gauge = Gauge('bulkhead_capacity', 'Concurrent requests allowed per bulkhead', ['bulkhead'],
+                                multiprocess_mode='livesum')
+bulkhead_rejected_counter = Counter('bulkhead_rejected', 'Requests shed because the bulkhead was full', ['bulkhead'])
+deadline_exceeded_counter = Counter('request_deadline_exceeded', 'Requests that ran out of time', ['bulkhead'])
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def parse_settings(value, cast):
+    """'reports=2,auth.login=4' -> {'reports': 2, 'auth.login': 4}, keys are blueprints or endpoints."""
+    settings = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        key, _, setting = item.partition('=')
+        settings[key.strip()] = cast(setting)
+    return settings
+
+
+class Bulkhead:
+    """Caps concurrent requests of a blueprint or endpoint, a full bulkhead rejects immediately instead of queueing."""
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.slots = BoundedSemaphore(limit)
+        self._inflight = bulkhead_inflight_gauge.labels(name)
+        bulkhead_capacity_gauge.labels(name).set(limit)
+
+    def try_enter(self):
+        if not self.slots.acquire(blocking=False):
+            bulkhead_rejected_counter.labels(self.name).inc()
+            return False
+        self._inflight.inc()
+        return True
+
+    def leave(self):
+        self._inflight.dec()
+        self.slots.release()
+
+
+class Bulkheads:
+
+    def __init__(self, default_limit, limits, exempt, default_deadline, deadlines):
+        self.default_limit = default_limit
+        self.limits = limits
+        self.exempt = exempt
+        self.default_deadline = default_deadline
+        self.deadlines = deadlines
+        self.bulkheads = {}
+
+    def key(self):
+        # an endpoint specific setting wins over the blueprint one
+        if request.endpoint in self.limits:
+            return request.endpoint
+        return request.blueprint or request.endpoint or '<unmatched>'
+
+    def get(self, key):
+        bulkhead = self.bulkheads.get(key)
+        if bulkhead is None:
+            bulkhead = self.bulkheads.setdefault(key, Bulkhead(key, self.limits.get(key, self.default_limit)))
+        return bulkhead
+
+    def before_request(self):
+        if request.blueprint in self.exempt or request.endpoint in self.exempt:
+            return None
+        key = self.key()
+        bulkhead = self.get(key)
+        if not bulkhead.try_enter():
+            return jsonify({'error': 'Service currently not available'}), 503, {'Retry-After': '1'}
+        g.bulkhead = bulkhead
+        timeout = self.deadlines.get(request.endpoint, self.deadlines.get(request.blueprint, self.default_deadline))
+        g.deadline = time.monotonic() + timeout
+        return None
+
+    def teardown_request(self, _):
+        # runs once a streamed response finished too, so the slot is held for the whole stream
+        bulkhead = g.pop('bulkhead', None)
+        if bulkhead is not None:
+            bulkhead.leave()
+
+
+def handle_deadline_exceeded(_):
+    bulkhead = g.get('bulkhead')
+    deadline_exceeded_counter.labels(bulkhead.name if bulkhead else '<none>').inc()
+    return jsonify({'error': 'Request deadline exceeded'}), 504
+
+
+def handle_operational_error(e):
+    # 57014 query_canceled, raised by postgres once the statement_timeout derived from the deadline passed
+    if getattr(e.orig, 'pgcode', None) == '57014':
+        return handle_deadline_exceeded(e)
+    return handle_error(e)
+
+
+def init_bulkheads(app, default_limit=None, limits=None, exempt=None, default_deadline=None, deadlines=None):
+    bulkheads = Bulkheads(
+        BULKHEAD_DEFAULT_LIMIT if default_limit is None else default_limit,
+        parse_settings(BULKHEAD_LIMITS, int) if limits is None else limits,
+        {name.strip() for name in BULKHEAD_EXEMPT.split(',') if name.strip()} if exempt is None else exempt,
+        REQUEST_DEADLINE if default_deadline is None else default_deadline,
+        parse_settings(REQUEST_DEADLINES, float) if deadlines is None else deadlines
+    )
+    app.extensions['bulkheads'] = bulkheads
+    app.before_request(bulkheads.before_request)
+    app.teardown_request(bulkheads.teardown_request)
+    app.errorhandler(DeadlineExceeded)(handle_deadline_exceeded)
+    app.errorhandler(OperationalError)(handle_operational_error)
+    return bulkheads
+
+
+def remaining():
+    """Seconds left until the current request's deadline, None outside of a request or without one."""
+    if not has_request_context() or 'deadline' not in g:
+        return None
+    return g.deadline - time.monotonic()
+
+
+def check_deadline():
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded()
+    return left
+
+
+def bounded_timeout(timeout=None):
+    """timeout capped to the time left for the request, raises when none is left."""
+    left = check_deadline()
+    if left is None:
+        return timeout
+    return left if timeout is None else min(timeout, left)
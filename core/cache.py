@@ -0,0 +1,110 @@
+from collections import OrderedDict
+from prometheus_client import Counter, Gauge
+from threading import Lock
+import time
+
+cache_hits_counter = Counter('cache_hits', 'Cache hits by cache name', ['cache'])
+cache_misses_counter = Counter('cache_misses', 'Cache misses by cache name', ['cache'])
+cache_size_gauge = Gauge('cache_size_bytes', 'Bytes held by size bounded caches', ['cache'], multiprocess_mode='livesum')
+
+
+class TTLCache:
+    """Process-local LRU cache whose entries expire after ttl seconds."""
+
+    def __init__(self, name, ttl, maxsize=1024):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._hits = cache_hits_counter.labels(name)
+        self._misses = cache_misses_counter.labels(name)
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    self._hits.inc()
+                    return entry[0]
+                del self._entries[key]
+        self._misses.inc()
+        return default
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = loader()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class LRUByteCache:
+    """Process-local LRU cache of bytes values bounded by their total size."""
+
+    def __init__(self, name, max_bytes):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._hits = cache_hits_counter.labels(name)
+        self._misses = cache_misses_counter.labels(name)
+        self._size = cache_size_gauge.labels(name)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self._hits.inc()
+                return value
+        self._misses.inc()
+        return None
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+            self._size.set(self.size)
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self.size = 0
+            elif key in self._entries:
+                self.size -= len(self._entries.pop(key))
+            self._size.set(self.size)
+
+    def __len__(self):
+        return len(self._entries)
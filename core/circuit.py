@@ -0,0 +1,187 @@
+import threading
+import time
+from functools import wraps
+from prometheus_client import Counter, Gauge
+from core.config import *
+from core.localstore import SqliteStore
+from core.logger import logger
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+STATES = (CLOSED, OPEN, HALF_OPEN)
+
+circuit_breaker_state_gauge = Gauge('circuit_breaker_state', 'Last seen breaker state, 1 for the current one',
+                                    ['breaker', 'state'], multiprocess_mode='livemax')
+circuit_breaker_transitions_counter = Counter('circuit_breaker_transitions', 'Breaker state changes',
+                                              ['breaker', 'from_state', 'to_state'])
+circuit_breaker_rejections_counter = Counter('circuit_breaker_rejections', 'Calls rejected by an open breaker',
+                                             ['breaker'])
+circuit_breaker_errors_counter = Counter('circuit_breaker_errors', 'Breaker checks skipped because the store failed',
+                                         ['breaker'])
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+def before_call(state, recovery_timeout, half_open_probes, now):
+    """
+    state is (state, failures, changed_at, probes), returns the new state and whether
+    the call may run. After recovery_timeout an open breaker lets half_open_probes calls
+    through at once; probes that never reported back are given up after another recovery_timeout.
+    """
+    name, failures, changed_at, probes = state or (CLOSED, 0, now, 0)
+    if name == CLOSED:
+        return (name, failures, changed_at, probes), True
+    if now - changed_at >= recovery_timeout:
+        return (HALF_OPEN, failures, now, 1), True
+    if name == HALF_OPEN and probes < half_open_probes:
+        return (name, failures, changed_at, probes + 1), True
+    return (name, failures, changed_at, probes), False
+
+
+def after_call(state, succeeded, failure_threshold, now):
+    """Records the outcome of an allowed call, returns the new state."""
+    name, failures, changed_at, probes = state or (CLOSED, 0, now, 0)
+    if name == HALF_OPEN:
+        # the first probe to finish decides, the others report into the new state
+        return (CLOSED, 0, now, 0) if succeeded else (OPEN, failures + 1, now, 0)
+    if name == OPEN:
+        return name, failures, changed_at, probes
+    if succeeded:
+        return name, 0, changed_at, probes
+    if failures + 1 >= failure_threshold:
+        return OPEN, failures + 1, now, 0
+    return name, failures + 1, changed_at, probes
+
+
+class MemoryBackend:
+    """Per-process store, used when no shared store is configured."""
+
+    def __init__(self):
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def update(self, key, transition):
+        with self.lock:
+            previous = self.states.get(key)
+            state, result = transition(previous)
+            # a breaker that was only looked at has no state to keep yet
+            if state is not None:
+                self.states[key] = state
+            return previous, state, result
+
+
+class SqliteBackend(SqliteStore):
+    """Store in a sqlite file shared by all worker processes on the host."""
+
+    def __init__(self, path, timeout=1.0):
+        super().__init__(path, 'CREATE TABLE IF NOT EXISTS circuit_breakers '
+                               '(key TEXT PRIMARY KEY, state TEXT, failures INTEGER, changed_at REAL, probes INTEGER)',
+                         timeout)
+
+    def update(self, key, transition):
+        with self.transaction() as connection:
+            previous = connection.execute('SELECT state, failures, changed_at, probes FROM circuit_breakers '
+                                          'WHERE key = ?', (key,)).fetchone()
+            state, result = transition(previous)
+            if state is not None and state != previous:
+                connection.execute('INSERT OR REPLACE INTO circuit_breakers VALUES (?, ?, ?, ?, ?)', (key, *state))
+        return previous, state, result
+
+
+def create_backend():
+    return SqliteBackend(CIRCUIT_BREAKER_STORE) if CIRCUIT_BREAKER_STORE else MemoryBackend()
+
+
+circuit_breaker_backend = create_backend()
+
+
+class CircuitBreaker:
+
+    def __init__(self, name, failure_threshold=5, recovery_timeout=30, expected_exception=Exception,
+                 half_open_probes=None, backend=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.expected_exception = expected_exception
+        self.half_open_probes = half_open_probes or CIRCUIT_BREAKER_HALF_OPEN_PROBES
+        self.backend = backend
+        self.observed = None
+        self._rejections = circuit_breaker_rejections_counter.labels(name)
+        self._observe(CLOSED)
+
+    def _update(self, transition):
+        """transition maps the stored state to (new state, result), returns the result."""
+        previous, state, result = (self.backend or circuit_breaker_backend).update(self.name, transition)
+        previous_name = previous[0] if previous else CLOSED
+        name = state[0] if state else CLOSED
+        if name != previous_name:
+            circuit_breaker_transitions_counter.labels(self.name, previous_name, name).inc()
+            logger.warning(f'Circuit breaker {self.name} changed from {previous_name} to {name}')
+        self._observe(name)
+        return result
+
+    def _observe(self, name):
+        if name != self.observed:
+            for state in STATES:
+                circuit_breaker_state_gauge.labels(self.name, state).set(int(state == name))
+            self.observed = name
+
+    def allow(self):
+        """Whether a call may go through, a half-open breaker counts it as one of its probes."""
+        try:
+            allowed = self._update(
+                lambda state: before_call(state, self.recovery_timeout, self.half_open_probes, time.time()))
+        except Exception as ex:
+            # an unavailable store must not take the protected call down with it
+            circuit_breaker_errors_counter.labels(self.name).inc()
+            logger.error(f'Circuit breaker {self.name} failed: {ex}')
+            return True
+        if not allowed:
+            self._rejections.inc()
+        return allowed
+
+    def record(self, succeeded):
+        try:
+            self._update(lambda state: (after_call(state, succeeded, self.failure_threshold, time.time()), None))
+        except Exception as ex:
+            circuit_breaker_errors_counter.labels(self.name).inc()
+            logger.error(f'Circuit breaker {self.name} failed: {ex}')
+
+    @property
+    def state(self):
+        return self._update(lambda state: (state, state[0] if state else CLOSED))
+
+
+def circuit(name, failure_threshold=5, recovery_timeout=30, expected_exception=Exception, half_open_probes=None,
+            fallback_function=None, backend=None):
+    """
+    Stops calling the view after failure_threshold consecutive expected_exception failures
+    and answers with fallback_function() until a probe succeeds again. The state lives in
+    the configured backend, so with CIRCUIT_BREAKER_STORE all workers on the host share it.
+    """
+    breaker = CircuitBreaker(name, failure_threshold, recovery_timeout, expected_exception, half_open_probes, backend)
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not breaker.allow():
+                if fallback_function is None:
+                    raise CircuitOpen(f'Circuit breaker {name} is open')
+                # the view arguments (e.g. user_id from validate_token) are not passed on
+                return fallback_function()
+            try:
+                result = f(*args, **kwargs)
+            except expected_exception:
+                breaker.record(False)
+                raise
+            # other exceptions leave the state alone, a probe ending in one is given up after recovery_timeout
+            breaker.record(True)
+            return result
+
+        wrapper.breaker = breaker
+        return wrapper
+
+    return decorator
@@ -5,13 +5,104 @@ DB_URI = os.environ.get('DB_URI', 'localhost:8432')
 DB_USER = os.environ.get('DB_USER', 'dbuser')
 DB_PASSWORD = os.environ.get('DB_PASSWORD', 'postgres')
 DB_NAME = os.environ.get('DB_NAME', 'workclock-db')
+DB_REPLICA_URI = os.environ.get('DB_REPLICA_URI', '')
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 30000))
 
 # jwt secret
 JWT_SECRET = os.environ.get('JWT_SECRET', 'default_value')
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+TOKEN_CACHE_TTL = float(os.environ.get('TOKEN_CACHE_TTL', 300))
+TOKEN_REVOCATION_SYNC_INTERVAL = float(os.environ.get('TOKEN_REVOCATION_SYNC_INTERVAL', 5))
+TOKEN_REVOCATION_SYNC_OVERLAP = float(os.environ.get('TOKEN_REVOCATION_SYNC_OVERLAP', 60))
 
 # mailer config
 SMTP_SENDER = os.environ.get('SMTP_SENDER', '')
 SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD', '')
+SMTP_HOST = os.environ.get('SMTP_HOST', 'smtp-mail.outlook.com')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 587))
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', 'true').lower() == 'true'
+SMTP_TIMEOUT = float(os.environ.get('SMTP_TIMEOUT', 30))
+SMTP_IDLE_TIMEOUT = float(os.environ.get('SMTP_IDLE_TIMEOUT', 60))
+MAIL_POLL_INTERVAL = float(os.environ.get('MAIL_POLL_INTERVAL', 30))
+MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE', 50))
+MAIL_MAX_ATTEMPTS = int(os.environ.get('MAIL_MAX_ATTEMPTS', 5))
+MAIL_RETRY_BACKOFF = float(os.environ.get('MAIL_RETRY_BACKOFF', 30))
 
 # is dev
-IS_DEV = os.environ.get('IS_DEV', False)
\ No newline at end of file
+IS_DEV = os.environ.get('IS_DEV', False)
+
+# reports config
+REPORT_RENDERER = os.environ.get('REPORT_RENDERER', 'pydyf')
+REPORT_FONT_PATH = os.environ.get('REPORT_FONT_PATH', os.path.join(os.path.dirname(__file__), 'fonts', 'DejaVuSans.ttf'))
+REPORT_STREAM_THRESHOLD = int(os.environ.get('REPORT_STREAM_THRESHOLD', 1024 * 1024))
+REPORT_STREAM_CHUNK_SIZE = int(os.environ.get('REPORT_STREAM_CHUNK_SIZE', 64 * 1024))
+
+# cache config
+EVENT_TYPE_CACHE_TTL = int(os.environ.get('EVENT_TYPE_CACHE_TTL', 300))
+PROFILE_CACHE_TTL = int(os.environ.get('PROFILE_CACHE_TTL', 60))
+PROFILE_CACHE_SIZE = int(os.environ.get('PROFILE_CACHE_SIZE', 10000))
+PROFILE_CACHE_SYNC_INTERVAL = float(os.environ.get('PROFILE_CACHE_SYNC_INTERVAL', 5))
+PROFILE_CACHE_SYNC_OVERLAP = float(os.environ.get('PROFILE_CACHE_SYNC_OVERLAP', 60))
+
+# report jobs config
+REPORT_JOB_WORKERS = int(os.environ.get('REPORT_JOB_WORKERS', 2))
+REPORT_JOB_MAX_PENDING = int(os.environ.get('REPORT_JOB_MAX_PENDING', 32))
+REPORT_JOB_RESULT_TTL = int(os.environ.get('REPORT_JOB_RESULT_TTL', 15 * 60))
+REPORT_JOB_STORE = os.environ.get('REPORT_JOB_STORE', '')
+REPORT_CACHE_MAX_BYTES = int(os.environ.get('REPORT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+REPORT_BATCH_WORKERS = int(os.environ.get('REPORT_BATCH_WORKERS', os.cpu_count() or 1))
+
+# password hashing config
+BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', PASSWORD_HASH_WORKERS * 8))
+PASSWORD_HASH_QUEUE_TIMEOUT = float(os.environ.get('PASSWORD_HASH_QUEUE_TIMEOUT', 5))
+
+# generated password config
+PASSWORD_WORD_COUNT = int(os.environ.get('PASSWORD_WORD_COUNT', 3))
+PASSWORD_MIN_ENTROPY_BITS = float(os.environ.get('PASSWORD_MIN_ENTROPY_BITS', 0))
+
+# elasticsearch logging config
+ES_URL = os.environ.get('ES_URL', 'http://elasticsearch:9200')
+ES_LOG_INDEX = os.environ.get('ES_LOG_INDEX', 'flask_logs')
+ES_LOG_QUEUE_SIZE = int(os.environ.get('ES_LOG_QUEUE_SIZE', 10000))
+ES_LOG_BATCH_SIZE = int(os.environ.get('ES_LOG_BATCH_SIZE', 500))
+ES_LOG_FLUSH_INTERVAL = float(os.environ.get('ES_LOG_FLUSH_INTERVAL', 2.0))
+ES_LOG_OVERFLOW = os.environ.get('ES_LOG_OVERFLOW', 'drop_newest')
+
+# auth config
+AUTH_BULK_MAX_ROWS = int(os.environ.get('AUTH_BULK_MAX_ROWS', 250))
+AUTH_USERS_PAGE_SIZE = int(os.environ.get('AUTH_USERS_PAGE_SIZE', 100))
+AUTH_USERS_MAX_PAGE_SIZE = int(os.environ.get('AUTH_USERS_MAX_PAGE_SIZE', 1000))
+
+# proxy config
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 1))
+
+# rate limit config
+RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE', '')
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 100000))
+LOGIN_RATE_LIMIT_WINDOW = float(os.environ.get('LOGIN_RATE_LIMIT_WINDOW', 60))
+LOGIN_RATE_LIMIT_PER_IP = int(os.environ.get('LOGIN_RATE_LIMIT_PER_IP', 30))
+LOGIN_RATE_LIMIT_PER_ACCOUNT = int(os.environ.get('LOGIN_RATE_LIMIT_PER_ACCOUNT', 10))
+
+# metrics config
+PROMETHEUS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR', '')
+
+# docs config
+ENABLE_SWAGGER = os.environ.get('ENABLE_SWAGGER', 'true').lower() == 'true'
+
+# bulkhead config
+BULKHEAD_DEFAULT_LIMIT = int(os.environ.get('BULKHEAD_DEFAULT_LIMIT', 3))
+BULKHEAD_LIMITS = os.environ.get('BULKHEAD_LIMITS', 'reports=2,faults=1')
+BULKHEAD_EXEMPT = os.environ.get('BULKHEAD_EXEMPT', 'health,metrics')
+REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE', 30))
+REQUEST_DEADLINES = os.environ.get('REQUEST_DEADLINES', 'reports=60,auth.register_bulk=120')
+
+# circuit breaker config
+CIRCUIT_BREAKER_STORE = os.environ.get('CIRCUIT_BREAKER_STORE', '')
+CIRCUIT_BREAKER_HALF_OPEN_PROBES = int(os.environ.get('CIRCUIT_BREAKER_HALF_OPEN_PROBES', 1))
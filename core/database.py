@@ -0,0 +1,115 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from flask_sqlalchemy.session import Session
+from prometheus_client import Gauge, Histogram
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+from core.bulkhead import bounded_timeout
+from core.config import *
+
+REPLICA = 'replica'
+
+db_pool_checkout_histogram = Histogram('db_pool_checkout_seconds', 'Time spent waiting for a pooled connection',
+                                       ['bind'])
+db_pool_checked_out_gauge = Gauge('db_pool_checked_out', 'Connections currently checked out of the pool', ['bind'],
+                                  multiprocess_mode='livesum')
+db_pool_size_gauge = Gauge('db_pool_size', 'Configured pool size', ['bind'], multiprocess_mode='livesum')
+db_pool_overflow_gauge = Gauge('db_pool_overflow', 'Connections open beyond the pool size', ['bind'],
+                               multiprocess_mode='livesum')
+
+use_replica = ContextVar('use_replica', default=False)
+
+
+class TimedQueuePool(QueuePool):
+    """Times checkouts and keeps the pool gauges current, values are pushed so they work in multiprocess mode."""
+    bind = 'primary'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        db_pool_size_gauge.labels(self.bind).set(self.size())
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            db_pool_checkout_histogram.labels(self.bind).observe(time.perf_counter() - started)
+            self._update_gauges()
+
+    def _do_return_conn(self, record):
+        super()._do_return_conn(record)
+        self._update_gauges()
+
+    def _update_gauges(self):
+        db_pool_checked_out_gauge.labels(self.bind).set(self.checkedout())
+        db_pool_overflow_gauge.labels(self.bind).set(max(self.overflow(), 0))
+
+
+class ReplicaQueuePool(TimedQueuePool):
+    bind = REPLICA
+
+
+class RoutingSession(Session):
+    """Sends queries made inside replica() to the replica bind when one is configured, flushes always go to the primary."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and use_replica.get() and not self._flushing and REPLICA in self._db.engines:
+            return self._db.engines[REPLICA]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_begin')
+def apply_request_deadline(session, transaction, connection):
+    """Caps the statements of a transaction begun inside a request to the time the request has left."""
+    timeout = bounded_timeout(DB_STATEMENT_TIMEOUT_MS / 1000 if DB_STATEMENT_TIMEOUT_MS else None)
+    if timeout is not None and connection.dialect.name == 'postgresql':
+        connection.exec_driver_sql(f'SET LOCAL statement_timeout = {max(1, int(timeout * 1000))}')
+
+
+@contextmanager
+def replica():
+    token = use_replica.set(True)
+    try:
+        yield
+    finally:
+        use_replica.reset(token)
+
+
+def iter_on_replica(iterable):
+    """For streamed responses, their generators run after the read_only view returned."""
+    with replica():
+        yield from iterable
+
+
+def read_only(f):
+    """Runs the view's queries against the replica."""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        with replica():
+            return f(*args, **kwargs)
+
+    return wrapper
+
+
+def engine_options(poolclass=TimedQueuePool):
+    options = {
+        'poolclass': poolclass,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+    }
+    if DB_STATEMENT_TIMEOUT_MS:
+        options['connect_args'] = {'options': f'-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}'}
+    return options
+
+
+def configure_database(app, uri, replica_uri=None):
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options()
+    if replica_uri:
+        app.config['SQLALCHEMY_BINDS'] = {REPLICA: {'url': replica_uri, **engine_options(ReplicaQueuePool)}}
+
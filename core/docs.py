@@ -0,0 +1,10 @@
+def swag_from(specs):
+    """
+    Attaches a dict of OpenAPI specs to the view the same way flasgger.swag_from does,
+    so the services don't import flasgger (and its jsonschema/yaml stack) when Swagger is disabled.
+    """
+    def decorator(f):
+        f.specs_dict = specs
+        return f
+
+    return decorator
@@ -0,0 +1,122 @@
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import get_context
+from prometheus_client import Counter, Gauge, Histogram
+from threading import BoundedSemaphore, Lock
+from core.bulkhead import DeadlineExceeded, bounded_timeout
+from core.config import *
+import bcrypt
+import hmac
+import time
+
+password_hash_inflight_gauge = Gauge('password_hash_inflight', 'Password hashing calls queued or running',
+                                     multiprocess_mode='livesum')
+password_hash_wait_histogram = Histogram('password_hash_wait_seconds', 'Time spent waiting for a hashing slot')
+password_hash_duration_histogram = Histogram('password_hash_duration_seconds',
+                                             'Password hashing duration by operation', ['operation'])
+password_hash_rejected_counter = Counter('password_hash_rejected', 'Hashing calls rejected because the pool was full')
+
+hash_pool = None
+hash_pool_lock = Lock()
+hash_slots = BoundedSemaphore(PASSWORD_HASH_MAX_PENDING)
+
+
+class HashingBusy(Exception):
+    pass
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=rounds)).decode('utf-8')
+
+
+def _hash_chunk(passwords, rounds):
+    return [_hash(password, rounds) for password in passwords]
+
+
+def _check(pw_hash, password):
+    pw_hash = pw_hash.encode('utf-8')
+    return hmac.compare_digest(bcrypt.hashpw(password.encode('utf-8'), pw_hash), pw_hash)
+
+
+def get_hash_pool():
+    global hash_pool
+    with hash_pool_lock:
+        if hash_pool is None:
+            hash_pool = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, mp_context=get_context('spawn'))
+        return hash_pool
+
+
+def shutdown_hash_pool():
+    global hash_pool
+    with hash_pool_lock:
+        if hash_pool is not None:
+            hash_pool.shutdown()
+            hash_pool = None
+
+
+def _release_when_done(futures):
+    # the slot stays taken until the pool finished the work, also when the caller gave up waiting
+    pending = [len(futures)]
+    lock = Lock()
+
+    def done(_):
+        with lock:
+            pending[0] -= 1
+            if pending[0]:
+                return
+        password_hash_inflight_gauge.dec()
+        hash_slots.release()
+
+    for future in futures:
+        future.add_done_callback(done)
+
+
+def _run(operation, *calls):
+    """Runs the (function, *args) calls on the pool under one backpressure slot, returns their results."""
+    started = time.perf_counter()
+    if not hash_slots.acquire(timeout=bounded_timeout(PASSWORD_HASH_QUEUE_TIMEOUT)):
+        password_hash_rejected_counter.inc()
+        raise HashingBusy('Password hashing pool is saturated')
+    password_hash_wait_histogram.observe(time.perf_counter() - started)
+    password_hash_inflight_gauge.inc()
+    try:
+        pool = get_hash_pool()
+        futures = [pool.submit(*call) for call in calls]
+    except BaseException:
+        password_hash_inflight_gauge.dec()
+        hash_slots.release()
+        raise
+    _release_when_done(futures)
+
+    with password_hash_duration_histogram.labels(operation).time():
+        _, not_done = wait(futures, timeout=bounded_timeout())
+    if not_done:
+        for future in not_done:
+            future.cancel()
+        raise DeadlineExceeded()
+    return [future.result() for future in futures]
+
+
+def hash_password(password, rounds=None):
+    if not password:
+        raise ValueError('Password must be non-empty.')
+    rounds = rounds or BCRYPT_LOG_ROUNDS
+    return _run('hash', (_hash, password, rounds))[0]
+
+
+def check_password(pw_hash, password):
+    if not pw_hash or not password:
+        return False
+    return _run('check', (_check, pw_hash, password))[0]
+
+
+def hash_passwords(passwords, rounds=None):
+    """Hashes a batch across all pool workers, the batch takes a single backpressure slot."""
+    if not all(passwords):
+        raise ValueError('Password must be non-empty.')
+    if not passwords:
+        return []
+    rounds = rounds or BCRYPT_LOG_ROUNDS
+    chunksize = max(1, len(passwords) // (PASSWORD_HASH_WORKERS * 4))
+    chunks = [passwords[start:start + chunksize] for start in range(0, len(passwords), chunksize)]
+    return [pw_hash for hashes in _run('hash_many', *((_hash_chunk, chunk, rounds) for chunk in chunks))
+            for pw_hash in hashes]
@@ -0,0 +1,163 @@
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client import Gauge, Histogram
+from threading import Lock
+from core.localstore import SqliteStore
+from core.logger import logger
+import time
+import uuid
+
+job_queue_depth_gauge = Gauge('job_queue_depth', 'Jobs queued or running by queue', ['queue'],
+                              multiprocess_mode='livesum')
+job_wait_histogram = Histogram('job_wait_seconds', 'Time jobs spend queued before running', ['queue'])
+job_latency_histogram = Histogram('job_latency_seconds', 'Time from job submission to completion', ['queue', 'status'])
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, owner, download_name=None):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.download_name = download_name
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.finished_at = None
+
+    @classmethod
+    def from_row(cls, row):
+        job = cls.__new__(cls)
+        (job.id, job.owner, job.download_name, job.status, job.error,
+         job.submitted_at, job.finished_at, job.result) = row
+        return job
+
+    def to_row(self):
+        return (self.id, self.owner, self.download_name, self.status, self.error,
+                self.submitted_at, self.finished_at, self.result)
+
+    def to_dict(self):
+        return {'job_id': self.id, 'status': self.status, 'error': self.error,
+                'submitted_at': self.submitted_at, 'finished_at': self.finished_at}
+
+
+class MemoryJobStore:
+    """Per-process store, jobs are only found by the process that ran them."""
+
+    def __init__(self):
+        self.jobs = {}
+        self.lock = Lock()
+
+    def save(self, job):
+        with self.lock:
+            self.jobs[job.id] = job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def purge(self, finished_before):
+        with self.lock:
+            for job_id in [job_id for job_id, job in self.jobs.items()
+                           if job.finished_at is not None and job.finished_at < finished_before]:
+                del self.jobs[job_id]
+
+
+class SqliteJobStore(SqliteStore):
+    """Store in a sqlite file shared by all worker processes on the host, status polls may land on any of them."""
+
+    def __init__(self, path, timeout=5.0):
+        super().__init__(path, 'CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, owner INTEGER, '
+                               'download_name TEXT, status TEXT, error TEXT, submitted_at REAL, finished_at REAL, '
+                               'result BLOB)', timeout)
+
+    def save(self, job):
+        with self.transaction() as connection:
+            connection.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)', job.to_row())
+
+    def get(self, job_id):
+        row = self.connection().execute('SELECT id, owner, download_name, status, error, submitted_at, '
+                                        'finished_at, result FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return Job.from_row(row) if row else None
+
+    def purge(self, finished_before):
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM jobs WHERE finished_at < ?', (finished_before,))
+
+
+class JobQueue:
+    """
+    Bounded job queue running on a thread pool of the submitting process, results kept
+    for result_ttl seconds in the store. max_pending applies per process.
+    """
+
+    def __init__(self, name, max_workers, max_pending, result_ttl, store=None):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self.store = store or MemoryJobStore()
+        self._pending = 0
+        self._lock = Lock()
+        self._executor = None
+        self._depth = job_queue_depth_gauge.labels(name)
+
+    def submit(self, owner, fn, *args, download_name=None):
+        job = Job(owner, download_name)
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise QueueFull(f'{self.name} queue is full ({self.max_pending} pending jobs)')
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix=f'{self.name}-job')
+            self._pending += 1
+        try:
+            self.store.purge(time.time() - self.result_ttl)
+            self.store.save(job)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+        self._depth.inc()
+        self._executor.submit(self._run, job, fn, *args)
+        return job
+
+    def get(self, job_id, owner=None):
+        job = self.store.get(job_id)
+        if job is None or (owner is not None and job.owner != owner):
+            return None
+        if job.finished_at is not None and job.finished_at < time.time() - self.result_ttl:
+            return None
+        return job
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+
+    def _run(self, job, fn, *args):
+        job.status = RUNNING
+        job_wait_histogram.labels(self.name).observe(time.time() - job.submitted_at)
+        try:
+            self.store.save(job)
+            job.result = fn(*args)
+            job.status = DONE
+        except Exception as ex:
+            logger.error(f'Job {job.id} in {self.name} queue failed: {ex}')
+            job.error = str(ex)
+            job.status = FAILED
+        finally:
+            job.finished_at = time.time()
+            job_latency_histogram.labels(self.name, job.status).observe(job.finished_at - job.submitted_at)
+            try:
+                self.store.save(job)
+            except Exception as ex:
+                logger.error(f'Job {job.id} in {self.name} queue could not be stored: {ex}')
+            with self._lock:
+                self._pending -= 1
+            self._depth.dec()
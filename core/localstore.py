@@ -0,0 +1,40 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class SqliteStore:
+    """A sqlite file shared by the worker processes on one host, with a connection per thread."""
+
+    def __init__(self, path, schema, timeout=1.0):
+        self.path = path
+        self.schema = schema
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(self.schema)
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        """BEGIN IMMEDIATE takes the write lock up front, so read-modify-write cycles of the workers don't interleave."""
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
@@ -1,7 +1,17 @@
 import logging
-from elasticsearch import Elasticsearch
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from prometheus_client import Counter, Gauge
 from core.config import *
 
+log_queue_depth_gauge = Gauge('log_queue_depth', 'Log records waiting to be shipped to Elasticsearch',
+                              multiprocess_mode='livesum')
+log_records_shipped_counter = Counter('log_records_shipped', 'Log records shipped to Elasticsearch')
+log_records_dropped_counter = Counter('log_records_dropped', 'Log records dropped before reaching Elasticsearch',
+                                      ['reason'])
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 stream_handler = logging.StreamHandler()
@@ -9,14 +19,121 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 stream_handler.setFormatter(formatter)
 logger.addHandler(stream_handler)
 
+
+class ElasticsearchHandler(logging.Handler):
+    """
+    Non-blocking handler - records are queued and a background thread ships them
+    with the _bulk API once batch_size records are waiting or flush_interval passed.
+    es is a client or a callable creating one, called on the shipper thread before the first send.
+    """
+
+    DROP_NEWEST = 'drop_newest'
+    DROP_OLDEST = 'drop_oldest'
+    STOP = object()
+
+    def __init__(self, es, index, queue_size=10000, batch_size=500, flush_interval=2.0, overflow=DROP_NEWEST):
+        super().__init__()
+        self.es = es
+        self.index = index
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._ship, name='es-log-shipper', daemon=True)
+        self.thread.start()
+
+    def emit(self, record):
+        try:
+            entry = {
+                '@timestamp': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+                'level': record.levelname,
+                'message': self.format(record),
+            }
+        except Exception:
+            self.handleError(record)
+            return
+
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            if self.overflow == self.DROP_OLDEST:
+                try:
+                    self.queue.get_nowait()
+                    self.queue.put_nowait(entry)
+                except (queue.Empty, queue.Full):
+                    pass
+            log_records_dropped_counter.labels('overflow').inc()
+
+    def flush(self, timeout=5.0):
+        if not self.thread.is_alive():
+            return
+        flushed = threading.Event()
+        try:
+            self.queue.put(flushed, timeout=timeout)
+        except queue.Full:
+            return
+        flushed.wait(timeout)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.flush()
+            self.stopped.set()
+            try:
+                self.queue.put(self.STOP, timeout=1)
+            except queue.Full:
+                pass
+            self.thread.join(5)
+        super().close()
+
+    def _ship(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while not self.stopped.is_set() or not self.queue.empty():
+            try:
+                item = self.queue.get(timeout=max(deadline - time.monotonic(), 0.01))
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, threading.Event):
+                self._send(batch)
+                batch = []
+                item.set()
+            elif item is not None and item is not self.STOP:
+                batch.append(item)
+
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                self._send(batch)
+                batch = []
+                log_queue_depth_gauge.set(self.queue.qsize())
+                deadline = time.monotonic() + self.flush_interval
+        self._send(batch)
+
+    def _send(self, batch):
+        if not batch:
+            return
+        operations = []
+        for entry in batch:
+            operations.append({'index': {'_index': self.index}})
+            operations.append(entry)
+        try:
+            if callable(self.es):
+                self.es = self.es()
+            self.es.bulk(operations=operations)
+            log_records_shipped_counter.inc(len(batch))
+        except Exception:
+            # the logger itself can't be used here, it would feed the failure back into the queue
+            log_records_dropped_counter.labels('send_error').inc(len(batch))
+
+
+def create_es_client():
+    # the client library is slow to import, only the shipper thread needs it
+    from elasticsearch import Elasticsearch
+    return Elasticsearch([ES_URL])
+
+
 # add elasticsearch logging for PROD
 if not IS_DEV:
-    es = Elasticsearch(['http://elasticsearch:9200'])
-    
-    class ElasticsearchHandler(logging.Handler):
-        def emit(self, record):
-            log_entry = self.format(record)
-            es.index(index='flask_logs', body={'message': log_entry})
-    
-    es_handler = ElasticsearchHandler()
+    es_handler = ElasticsearchHandler(create_es_client, ES_LOG_INDEX, queue_size=ES_LOG_QUEUE_SIZE, batch_size=ES_LOG_BATCH_SIZE,
+                                      flush_interval=ES_LOG_FLUSH_INTERVAL, overflow=ES_LOG_OVERFLOW)
     logger.addHandler(es_handler)
@@ -1,27 +1,166 @@
 import smtplib
+import threading
+import time
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from prometheus_client import Counter, Gauge
 from core.config import *
 from core.logger import logger
+from core.models import db, OutboxMessage
 
+mail_sent_counter = Counter('mail_sent', 'Emails delivered from the outbox')
+mail_failed_counter = Counter('mail_failed', 'Failed email delivery attempts')
+mail_outbox_pending_gauge = Gauge('mail_outbox_pending', 'Emails waiting in the outbox after the last sender pass',
+                                  multiprocess_mode='livemax')
 
-def send_email(receiver, subject, content):
-    if not SMTP_SENDER or not SMTP_PASSWORD:
-        logger.warning('SMTP_SENDER or SMTP_PASSWORD not set, email will not be sent')
+
+def send_email(receiver, subject, content, commit=True):
+    """
+    Queues the email in the outbox table, delivery happens on the background sender.
+    With commit=False the message is only added to the session, so it is stored
+    atomically with the caller's own changes.
+    """
+    if not SMTP_SENDER:
+        logger.warning('SMTP_SENDER not set, email will not be sent')
         return
-    
-    message = f"""
-    From: From WorkClock team <{SMTP_SENDER}>
-    To: To Person <{receiver}>
-    Subject: {subject}
-
-    {content}
-    """.strip()
-
-    try:
-        smtp_object = smtplib.SMTP('smtp-mail.outlook.com', 587)
-        smtp_object.starttls()
-        smtp_object.login(SMTP_SENDER, SMTP_PASSWORD)
-        smtp_object.sendmail(SMTP_SENDER, receiver, message)
-        logger.info(f'Successfully sent email to {receiver}\nContent: {content}')
-    except Exception as ex:
-        logger.error(f"Error: unable to send email to {receiver}\n{str(ex)}")
 
+    db.session.add(OutboxMessage(receiver=receiver, subject=subject, content=content))
+    if commit:
+        db.session.commit()
+        mail_sender.wake()
+
+
+def build_message(receiver, subject, content):
+    message = EmailMessage()
+    message['From'] = f'WorkClock team <{SMTP_SENDER}>'
+    message['To'] = receiver
+    message['Subject'] = subject
+    message.set_content(content)
+    return message
+
+
+class MailSender:
+    """
+    Background thread delivering outbox messages over a single SMTP session
+    that is kept open between batches and reopened when the server drops it.
+    Started once per server process, its first pass sweeps what earlier processes left pending.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.smtp = None
+        self.last_used = 0
+        self.thread = None
+        self.woken = threading.Event()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+
+    def start(self):
+        with self.lock:
+            if self.app is None or (self.thread is not None and self.thread.is_alive()):
+                return
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._run, name='mail-sender', daemon=True)
+            self.thread.start()
+
+    def wake(self):
+        self.start()
+        self.woken.set()
+
+    def stop(self, timeout=10):
+        self.stopped.set()
+        self.woken.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self._disconnect()
+
+    def _run(self):
+        with self.app.app_context():
+            while not self.stopped.is_set():
+                self.woken.clear()
+                try:
+                    sent_full_batch = self.send_pending()
+                except Exception as ex:
+                    logger.error(f'Mail sender pass failed: {ex}')
+                    db.session.rollback()
+                    sent_full_batch = False
+                finally:
+                    db.session.remove()
+
+                if self.smtp is not None and time.monotonic() - self.last_used > SMTP_IDLE_TIMEOUT:
+                    self._disconnect()
+                if not sent_full_batch:
+                    self.woken.wait(MAIL_POLL_INTERVAL)
+
+    def send_pending(self):
+        now = datetime.utcnow()
+        # SKIP LOCKED lets several workers drain the outbox without sending a message twice
+        messages = OutboxMessage.query.filter(
+            OutboxMessage.sent_at.is_(None),
+            OutboxMessage.attempts < MAIL_MAX_ATTEMPTS,
+            OutboxMessage.next_attempt_at <= now
+        ).order_by(OutboxMessage.id).limit(MAIL_BATCH_SIZE).with_for_update(skip_locked=True).all()
+
+        for message in messages:
+            try:
+                self._deliver(message)
+                message.sent_at = datetime.utcnow()
+                # welcome emails carry the generated password, it must not stay in the table
+                message.content = ''
+                mail_sent_counter.inc()
+                logger.info(f'Successfully sent email to {message.receiver}')
+            except Exception as ex:
+                message.attempts += 1
+                message.last_error = str(ex)
+                message.next_attempt_at = datetime.utcnow() + timedelta(
+                    seconds=MAIL_RETRY_BACKOFF * 2 ** (message.attempts - 1))
+                mail_failed_counter.inc()
+                logger.error(f'Error: unable to send email to {message.receiver} (attempt {message.attempts})\n{ex}')
+                if message.attempts >= MAIL_MAX_ATTEMPTS:
+                    message.content = ''
+                self._disconnect()
+        db.session.commit()
+
+        mail_outbox_pending_gauge.set(OutboxMessage.query.filter(
+            OutboxMessage.sent_at.is_(None),
+            OutboxMessage.attempts < MAIL_MAX_ATTEMPTS
+        ).count())
+        return len(messages) == MAIL_BATCH_SIZE
+
+    def _deliver(self, message):
+        email = build_message(message.receiver, message.subject, message.content)
+        try:
+            self._connection().send_message(email, SMTP_SENDER, [message.receiver])
+        except smtplib.SMTPServerDisconnected:
+            self._disconnect()
+            self._connection().send_message(email, SMTP_SENDER, [message.receiver])
+        self.last_used = time.monotonic()
+
+    def _connection(self):
+        if self.smtp is None:
+            smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+            if SMTP_STARTTLS:
+                smtp.starttls()
+            if SMTP_PASSWORD:
+                smtp.login(SMTP_SENDER, SMTP_PASSWORD)
+            self.smtp = smtp
+        return self.smtp
+
+    def _disconnect(self):
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except Exception:
+            pass
+        self.smtp = None
+
+
+mail_sender = MailSender()
+
+
+def init_mailer(app):
+    mail_sender.init_app(app)
@@ -0,0 +1,131 @@
+"""
+Versioned schema changes. Every migration runs once, in order, and is recorded in
+the schema_migrations table. Run them with `flask migrate` before starting the app.
+"""
+import click
+from datetime import datetime
+from flask.cli import with_appcontext
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, or_, select, text
+from core.config import MAIL_MAX_ATTEMPTS
+from core.models import db, Event, EventType, OutboxMessage, ProfileChange, RevokedToken, User
+
+# arbitrary key, keeps two replicas from migrating at once
+MIGRATION_LOCK_ID = 720451
+
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('name', String(255), nullable=False),
+    Column('applied_at', DateTime, nullable=False)
+)
+
+
+def create_tables(*models):
+    def migration(engine):
+        with engine.begin() as connection:
+            for model in models:
+                model.__table__.create(connection, checkfirst=True)
+
+    return migration
+
+
+def create_index(model, name):
+    index = next(index for index in model.__table__.indexes if index.name == name)
+
+    def migration(engine):
+        if engine.dialect.name == 'postgresql':
+            # CONCURRENTLY doesn't block writes to a big table, but can't run inside a transaction
+            columns = ', '.join(column.name for column in index.columns)
+            with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                connection.execute(text(
+                    f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {index.name} ON {model.__tablename__} ({columns})'
+                ))
+        else:
+            with engine.begin() as connection:
+                index.create(connection, checkfirst=True)
+
+    return migration
+
+
+def redact_outbox(engine):
+    # messages delivered or given up on before their content was cleared after sending
+    outbox = OutboxMessage.__table__
+    with engine.begin() as connection:
+        connection.execute(outbox.update().where(
+            or_(outbox.c.sent_at.isnot(None), outbox.c.attempts >= MAIL_MAX_ATTEMPTS)).values(content=''))
+
+
+def add_column(model, name):
+    column = model.__table__.c[name]
+
+    def migration(engine):
+        if name in {existing['name'] for existing in inspect(engine).get_columns(model.__tablename__)}:
+            return
+        definition = f'{name} {column.type.compile(engine.dialect)}'
+        # sqlite can't add a column with a non-constant default, its existing and new rows stay NULL there
+        if column.server_default is not None and engine.dialect.name != 'sqlite':
+            definition += f' DEFAULT {column.server_default.arg.compile(dialect=engine.dialect)}'
+        with engine.begin() as connection:
+            connection.execute(text(f'ALTER TABLE {model.__tablename__} ADD COLUMN {definition}'))
+
+    return migration
+
+
+MIGRATIONS = [
+    (1, 'users, events and event types', create_tables(User, Event, EventType)),
+    (2, 'mail outbox', create_tables(OutboxMessage)),
+    (3, 'revoked tokens', create_tables(RevokedToken)),
+    (4, 'events (user_id, start_date) index', create_index(Event, 'ix_events_user_id_start_date')),
+    (5, 'events previous_event_id index', create_index(Event, 'ix_events_previous_event_id')),
+    (6, 'redact delivered outbox messages', redact_outbox),
+    (7, 'revoked tokens created_at', add_column(RevokedToken, 'created_at')),
+    (8, 'profile changes', create_tables(ProfileChange)),
+]
+
+
+def applied_versions(engine):
+    schema_migrations.create(engine, checkfirst=True)
+    with engine.connect() as connection:
+        return set(connection.execute(select(schema_migrations.c.version)).scalars())
+
+
+def migrate(engine, target=None):
+    """Applies the pending migrations up to target, returns the (version, name) pairs applied."""
+    lock = engine.connect()
+    try:
+        if engine.dialect.name == 'postgresql':
+            lock.execute(text('SELECT pg_advisory_lock(:id)'), {'id': MIGRATION_LOCK_ID})
+        applied = applied_versions(engine)
+        done = []
+        for version, name, migration in MIGRATIONS:
+            if version in applied or (target is not None and version > target):
+                continue
+            migration(engine)
+            with engine.begin() as connection:
+                connection.execute(schema_migrations.insert().values(
+                    version=version, name=name, applied_at=datetime.utcnow()))
+            done.append((version, name))
+        return done
+    finally:
+        if engine.dialect.name == 'postgresql':
+            lock.execute(text('SELECT pg_advisory_unlock(:id)'), {'id': MIGRATION_LOCK_ID})
+        lock.close()
+
+
+@click.command('migrate')
+@click.option('--to', 'target', type=int, help='Stop after this version.')
+@click.option('--status', is_flag=True, help='List migrations without applying them.')
+@with_appcontext
+def migrate_command(target, status):
+    """Applies pending schema migrations."""
+    if status:
+        applied = applied_versions(db.engine)
+        for version, name, _ in MIGRATIONS:
+            click.echo(f'{"applied" if version in applied else "pending":<8} {version:>3} {name}')
+        return
+
+    done = migrate(db.engine, target)
+    for version, name in done:
+        click.echo(f'applied  {version:>3} {name}')
+    if not done:
+        click.echo('Schema is up to date')
@@ -1,7 +1,9 @@
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
+from core.database import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 bcrypt = Bcrypt()
 
 class User(db.Model):
@@ -16,6 +18,10 @@ class User(db.Model):
 
 class Event(db.Model):
     __tablename__ = 'events'
+    __table_args__ = (
+        db.Index('ix_events_user_id_start_date', 'user_id', 'start_date'),
+        db.Index('ix_events_previous_event_id', 'previous_event_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String)
     start_date = db.Column(db.DateTime)
@@ -30,4 +36,35 @@ class EventType(db.Model):
     __tablename__ = 'event_types'
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String)
-    is_paid = db.Column(db.Boolean)
\ No newline at end of file
+    is_paid = db.Column(db.Boolean)
+
+
+class OutboxMessage(db.Model):
+    __tablename__ = 'mail_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    receiver = db.Column(db.String(255), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.String)
+    sent_at = db.Column(db.DateTime)
+
+
+class RevokedToken(db.Model):
+    __tablename__ = 'revoked_tokens'
+    id = db.Column(db.Integer, primary_key=True)
+    jti = db.Column(db.String(36))
+    user_id = db.Column(db.Integer)
+    revoked_before = db.Column(db.Float)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    # set by the database, so every worker compares it against the same clock
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+
+
+class ProfileChange(db.Model):
+    __tablename__ = 'profile_changes'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, server_default=db.func.now(), index=True)
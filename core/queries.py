@@ -0,0 +1,229 @@
+import threading
+import time
+from datetime import timedelta
+from sqlalchemy import func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from core.cache import TTLCache
+from core.config import *
+from core.logger import logger
+from core.models import db, Event, EventType, ProfileChange, User
+
+USER_FIELDS = ('id', 'name', 'gmail', 'is_admin', 'created_by')
+UNKNOWN_EVENT_TYPE = 'Unknown'
+
+event_type_cache = TTLCache('event_types', EVENT_TYPE_CACHE_TTL, maxsize=1)
+profile_cache = TTLCache('profiles', PROFILE_CACHE_TTL, maxsize=PROFILE_CACHE_SIZE)
+
+
+def duration_seconds_sum(start_column, end_column):
+    """SUM(end - start) in seconds, expressed in the dialect of the bound engine."""
+    if db.engine.dialect.name == 'sqlite':
+        return func.sum((func.julianday(end_column) - func.julianday(start_column)) * 86400)
+    return func.extract('epoch', func.sum(end_column - start_column))
+
+
+def epoch_seconds_sum(column):
+    """SUM of the column's unix timestamps, expressed in the dialect of the bound engine."""
+    if db.engine.dialect.name == 'sqlite':
+        return func.sum((func.julianday(column) - 2440587.5) * 86400)
+    return func.sum(func.extract('epoch', column))
+
+
+def user_events_filter(user_id, since, until=None):
+    conditions = [Event.start_date >= since, Event.user_id == user_id]
+    if until is not None:
+        conditions.append(Event.start_date < until)
+    return conditions
+
+
+def monthly_event_rows(user_id, since):
+    stmt = select(Event.event_type_id, Event.start_date, Event.end_date).where(
+        *user_events_filter(user_id, since)
+    ).order_by(Event.start_date)
+    return db.session.execute(stmt).all()
+
+
+def stream_event_rows(user_id, since, until=None, batch_size=1000):
+    """Same projection as monthly_event_rows read through a server-side cursor."""
+    stmt = select(Event.id, Event.event_type_id, Event.start_date, Event.end_date).where(
+        *user_events_filter(user_id, since, until)
+    ).order_by(Event.start_date, Event.id).execution_options(yield_per=batch_size)
+    return db.session.execute(stmt)
+
+
+def all_users_event_rows(since, batch_size=1000):
+    """Events of every user since a date in one streamed query, users without events yield a single empty row."""
+    stmt = select(User.id.label('user_id'), User.gmail, Event.event_type_id, Event.start_date, Event.end_date).outerjoin(
+        Event, (Event.user_id == User.id) & (Event.start_date >= since)
+    ).order_by(User.id, Event.start_date).execution_options(yield_per=batch_size)
+    return db.session.execute(stmt)
+
+
+def hours_by_event_type(user_id, since, until=None):
+    stmt = select(
+        Event.event_type_id,
+        duration_seconds_sum(Event.start_date, Event.end_date).label('seconds')
+    ).where(
+        *user_events_filter(user_id, since, until)
+    ).group_by(Event.event_type_id)
+    return {row.event_type_id: round(float(row.seconds or 0), 3) / 3600 for row in db.session.execute(stmt)}
+
+
+def events_fingerprint(user_id, since):
+    """Cheap summary of the user's events since a date, changes whenever a report would."""
+    stmt = select(
+        func.count(Event.id),
+        func.max(Event.id),
+        # weighted by id so moving a type from one event to another shows too
+        func.sum(func.coalesce(Event.event_type_id, 0) * Event.id),
+        epoch_seconds_sum(Event.start_date),
+        epoch_seconds_sum(Event.end_date),
+        duration_seconds_sum(Event.start_date, Event.end_date)
+    ).where(
+        *user_events_filter(user_id, since)
+    )
+    return tuple(db.session.execute(stmt).one())
+
+
+def event_type_titles(refresh=False):
+    """id -> title of all event types, served from the process cache."""
+    if refresh:
+        event_type_cache.invalidate()
+    return event_type_cache.get_or_load('titles', lambda: dict(
+        db.session.execute(select(EventType.id, EventType.title)).all()
+    ))
+
+
+class EventTypeTitles:
+    """
+    Title lookup for a single report or export: a missing id reloads the cached titles,
+    at most once, ids still missing (or NULL) get UNKNOWN_EVENT_TYPE.
+    """
+
+    def __init__(self):
+        self.titles = event_type_titles()
+        self.refreshed = False
+
+    def _refresh(self):
+        if not self.refreshed:
+            self.titles = event_type_titles(refresh=True)
+            self.refreshed = True
+
+    def title(self, event_type_id):
+        if event_type_id not in self.titles:
+            self._refresh()
+        return self.titles.get(event_type_id, UNKNOWN_EVENT_TYPE)
+
+    def covering(self, event_type_ids):
+        """All known titles, reloaded first if any of the ids is missing."""
+        if any(event_type_id not in self.titles for event_type_id in event_type_ids):
+            self._refresh()
+        return self.titles
+
+
+def invalidate_event_types():
+    event_type_cache.invalidate()
+
+
+def insert_users_skip_conflicts(rows):
+    """One multi-row INSERT, rows whose gmail already exists are skipped. Returns gmail -> id of inserted users."""
+    dialect_insert = sqlite.insert if db.engine.dialect.name == 'sqlite' else postgresql.insert
+    stmt = dialect_insert(User).values(rows).on_conflict_do_nothing(
+        index_elements=[User.gmail]
+    ).returning(User.id, User.gmail)
+    return {row.gmail: row.id for row in db.session.execute(stmt)}
+
+
+def user_rows(fields, after_id=None, limit=None, batch_size=1000):
+    """Users ordered by id after the keyset cursor, selecting only the given USER_FIELDS. Streamed without a limit."""
+    stmt = select(*(getattr(User, field) for field in fields)).order_by(User.id)
+    if after_id is not None:
+        stmt = stmt.where(User.id > after_id)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    else:
+        stmt = stmt.execution_options(yield_per=batch_size)
+    return db.session.execute(stmt)
+
+
+class ProfileChanges:
+    """
+    Drops the profiles other workers changed from this process' cache, at most once per sync_interval.
+    Works like the RevocationList: it reads the profile_changes rows created since the newest one it
+    has seen, minus overlap seconds. Rows stay in that window for overlap seconds, so a profile read
+    back from a lagging replica in the meantime is dropped again on the next sync.
+    """
+
+    def __init__(self, sync_interval, overlap=PROFILE_CACHE_SYNC_OVERLAP):
+        self.sync_interval = sync_interval
+        self.overlap = timedelta(seconds=overlap)
+        self.last_seen = None
+        self.next_sync = 0
+        self.lock = threading.Lock()
+
+    def poll(self):
+        if time.monotonic() >= self.next_sync:
+            self.sync(blocking=False)
+
+    def sync(self, blocking=True):
+        # one thread syncs, the rest keep serving from the cache
+        if not self.lock.acquire(blocking=blocking):
+            return
+        try:
+            query = select(ProfileChange.user_id, ProfileChange.created_at)
+            if self.last_seen is not None:
+                query = query.where(ProfileChange.created_at >= self.last_seen - self.overlap)
+            # its own connection, a failed sync must not abort the transaction of the request that triggered it
+            with db.engine.connect() as connection:
+                rows = connection.execute(query).all()
+            for row in rows:
+                profile_cache.invalidate(row.user_id)
+                if row.created_at is not None and (self.last_seen is None or row.created_at > self.last_seen):
+                    self.last_seen = row.created_at
+        except Exception as ex:
+            logger.error(f'Profile cache sync failed: {ex}')
+        finally:
+            self.next_sync = time.monotonic() + self.sync_interval
+            self.lock.release()
+
+    def clear(self):
+        with self.lock:
+            self.last_seen = None
+            self.next_sync = 0
+
+
+profile_changes = ProfileChanges(PROFILE_CACHE_SYNC_INTERVAL)
+
+
+def user_profile(user_id):
+    """id, gmail, name, is_admin of the user or None, served from the process cache. Missing users aren't cached."""
+    profile_changes.poll()
+    profile = profile_cache.get(user_id)
+    if profile is None:
+        row = db.session.execute(
+            select(User.id, User.gmail, User.name, User.is_admin).where(User.id == user_id)
+        ).one_or_none()
+        if row is None:
+            return None
+        profile = row._asdict()
+        profile_cache.set(user_id, profile)
+    return profile
+
+
+def store_profile(user):
+    """Write-through after an update, so a lagging replica can't put the old profile back into the cache."""
+    profile_cache.set(user.id, {'id': user.id, 'gmail': user.gmail, 'name': user.name, 'is_admin': user.is_admin})
+
+
+def invalidate_profile(user_id):
+    profile_cache.invalidate(user_id)
+
+
+def record_profile_change(user_id):
+    """Stored with the caller's transaction, every other worker drops the cached profile on its next sync."""
+    # changes older than a cached profile can live are of no use to any worker, clean them up on the way
+    newest = db.session.scalar(select(func.max(ProfileChange.created_at)))
+    if newest is not None:
+        cutoff = newest - timedelta(seconds=PROFILE_CACHE_TTL + PROFILE_CACHE_SYNC_OVERLAP)
+        ProfileChange.query.filter(ProfileChange.created_at < cutoff).delete()
+    db.session.add(ProfileChange(user_id=user_id))
@@ -0,0 +1,136 @@
+import math
+import threading
+import time
+from flask import jsonify, request
+from functools import wraps
+from prometheus_client import Counter
+from core.config import *
+from core.localstore import SqliteStore
+from core.logger import logger
+
+rate_limit_rejections_counter = Counter('rate_limit_rejections', 'Requests rejected by a rate limiter', ['limiter'])
+rate_limit_errors_counter = Counter('rate_limit_errors', 'Rate limit checks skipped because the store failed',
+                                    ['limiter'])
+
+
+def slide(state, limit, window, now):
+    """
+    Sliding window counter: the previous fixed window's count is weighted by how much
+    of it still overlaps the sliding window. state is (window_start, previous, current),
+    returns the new state and 0 if the hit is allowed or the seconds to wait otherwise.
+    """
+    window_start, previous, current = state or (now, 0, 0)
+    elapsed_windows = int((now - window_start) // window)
+    if elapsed_windows:
+        previous = current if elapsed_windows == 1 else 0
+        current = 0
+        window_start += elapsed_windows * window
+    elapsed = now - window_start
+
+    if previous * (1 - elapsed / window) + current < limit:
+        return (window_start, previous, current + 1), 0
+
+    if current < limit:
+        # the previous window's weight drops below the remaining allowance
+        retry_after = window * (1 - (limit - current) / previous) - elapsed
+    else:
+        # only possible in the next window once this one's weight decayed enough
+        retry_after = window - elapsed + window * (1 - limit / current)
+    return (window_start, previous, current), max(retry_after, 0.001)
+
+
+class MemoryBackend:
+    """Per-process store, used when no shared store is configured."""
+
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def hit(self, key, limit, window, now):
+        with self.lock:
+            state, retry_after = slide(self.states.pop(key, None), limit, window, now)
+            self.states[key] = state
+            if len(self.states) > self.max_keys:
+                self._evict(window, now)
+            return retry_after
+
+    def _evict(self, window, now):
+        # keys are in last hit order, so the stale ones are at the front
+        for key in list(self.states):
+            if len(self.states) <= self.max_keys and self.states[key][0] > now - 2 * window:
+                break
+            del self.states[key]
+
+
+class SqliteBackend(SqliteStore):
+    """Store in a sqlite file shared by all worker processes on the host."""
+
+    def __init__(self, path, timeout=1.0):
+        super().__init__(path, 'CREATE TABLE IF NOT EXISTS rate_limits '
+                               '(key TEXT PRIMARY KEY, window_start REAL, previous INTEGER, current INTEGER)', timeout)
+        self.hits = 0
+
+    def hit(self, key, limit, window, now):
+        with self.transaction() as connection:
+            state = connection.execute('SELECT window_start, previous, current FROM rate_limits WHERE key = ?',
+                                       (key,)).fetchone()
+            state, retry_after = slide(state, limit, window, now)
+            connection.execute('INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?, ?)', (key, *state))
+            self.hits += 1
+            if self.hits % 1000 == 0:
+                connection.execute('DELETE FROM rate_limits WHERE window_start < ?', (now - 2 * window,))
+        return retry_after
+
+
+def create_backend():
+    return SqliteBackend(RATE_LIMIT_STORE) if RATE_LIMIT_STORE else MemoryBackend()
+
+
+rate_limit_backend = create_backend()
+
+
+class RateLimiter:
+
+    def __init__(self, name, limit, window, backend=None):
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self.backend = backend
+
+    def hit(self, key):
+        """Counts a request for key, returns 0 if allowed or the seconds until it would be."""
+        try:
+            return (self.backend or rate_limit_backend).hit(f'{self.name}:{key}', self.limit, self.window, time.time())
+        except Exception as ex:
+            # an unavailable store must not lock everybody out
+            rate_limit_errors_counter.labels(self.name).inc()
+            logger.error(f'Rate limiter {self.name} failed: {ex}')
+            return 0
+
+
+def client_ip():
+    return request.remote_addr
+
+
+def rate_limit(*rules):
+    """
+    Rejects the request with 429 before the view runs when any (limiter, key_func) rule
+    is over its limit. A key_func returning None skips its rule.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            for limiter, key_func in rules:
+                key = key_func()
+                if key is None:
+                    continue
+                retry_after = limiter.hit(key)
+                if retry_after:
+                    rate_limit_rejections_counter.labels(limiter.name).inc()
+                    return jsonify({'message': 'Too many requests'}), 429, {'Retry-After': str(math.ceil(retry_after))}
+            return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
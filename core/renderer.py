@@ -0,0 +1,340 @@
+import pydyf
+from functools import lru_cache
+from io import BytesIO
+from core.config import *
+
+MONTHLY_EVENTS_TITLE = 'Monthly events'
+GROUPED_EVENTS_TITLE = 'Grouped monthly events'
+DATE_FORMAT = '%d/%m/%Y %H:%M'
+
+# A4 portrait in PDF points
+PAGE_WIDTH = 595
+PAGE_HEIGHT = 842
+MARGIN = 40
+TITLE_SIZE = 18
+FONT_SIZE = 10
+ROW_HEIGHT = 16
+CELL_PADDING = 4
+
+
+def format_date(value):
+    # events that are still open have no end date yet
+    return value.strftime(DATE_FORMAT) if value is not None else ''
+
+
+class PdfkitRenderer:
+    """Legacy backend - renders HTML with an external wkhtmltopdf process."""
+    name = 'pdfkit'
+
+    def monthly_events(self, rows):
+        html = '''
+            <h1>Monthly events</h1>
+            <table style="width: 100%; border-collapse: collapse; border: 1px solid black;">
+            <tr>
+                <th style="border: 1px solid black;">Event type</th>
+                <th style="border: 1px solid black;">Start</th>
+                <th style="border: 1px solid black;">End</th>
+            </tr>'''
+
+        for title, start_date, end_date in rows:
+            html += f'''<tr>
+                <td style="border: 1px solid black;">&nbsp;&nbsp;{title}</td>
+                <td style="border: 1px solid black;">&nbsp;&nbsp;{start_date.strftime(DATE_FORMAT)}</td>
+                <td style="border: 1px solid black;">&nbsp;&nbsp;{format_date(end_date)}</td>
+            </tr>'''
+        html += '</table>'
+        return self._to_pdf(html)
+
+    def grouped_events(self, data):
+        html = f'''
+        <h1>Grouped monthly events</h1>
+        <table style="width: 100%; border-collapse: collapse; border: 1px solid black;">
+            <tr>{"".join(f'<th style="border: 1px solid black;">{item[1]}</th>' for item in data)}</tr>
+            <tr>{"".join(f'<td style="border: 1px solid black;">&nbsp;&nbsp;{item[0]}</td>' for item in data)}</tr>
+        </table>
+        '''
+        return self._to_pdf(html)
+
+    @staticmethod
+    def _to_pdf(html):
+        import pdfkit
+        return pdfkit.from_string(html, False)
+
+
+class PydyfRenderer:
+    """In-process backend - writes the PDF objects directly with pydyf."""
+    name = 'pydyf'
+
+    def __init__(self, font_path=None):
+        self.font_path = font_path
+
+    def monthly_events(self, rows):
+        usable = PAGE_WIDTH - 2 * MARGIN
+        date_width = 130
+        table = _TableDocument(self._font(), MONTHLY_EVENTS_TITLE,
+                               [usable - 2 * date_width, date_width, date_width],
+                               ['Event type', 'Start', 'End'])
+        for title, start_date, end_date in rows:
+            table.add_row([title, start_date.strftime(DATE_FORMAT), format_date(end_date)])
+        return table.to_bytes()
+
+    def grouped_events(self, data):
+        usable = PAGE_WIDTH - 2 * MARGIN
+        hours_width = 120
+        table = _TableDocument(self._font(), GROUPED_EVENTS_TITLE,
+                               [usable - hours_width, hours_width],
+                               ['Event type', 'Hours'])
+        for hours, title in data:
+            table.add_row([title, f'{hours:.2f}'])
+        return table.to_bytes()
+
+    def _font(self):
+        if self.font_path:
+            return _TrueTypeFont(_load_truetype(self.font_path))
+        return _StandardFont()
+
+
+class _StandardFont:
+    """Base-14 Helvetica, nothing embedded, text limited to WinAnsi."""
+
+    def __init__(self):
+        self.dictionary = pydyf.Dictionary({
+            'Type': '/Font',
+            'Subtype': '/Type1',
+            'BaseFont': '/Helvetica',
+            'Encoding': '/WinAnsiEncoding',
+        })
+
+    def register(self, pdf):
+        pdf.add_object(self.dictionary)
+
+    def encode(self, text):
+        return pydyf.String(str(text).encode('cp1252', 'replace')).data
+
+    def finish(self, pdf):
+        pass
+
+
+class _TrueTypeFont:
+    """Embedded TrueType font addressed by glyph ids (Identity-H)."""
+
+    def __init__(self, font):
+        self.font = font
+        self.used = {}
+        self.dictionary = pydyf.Dictionary({
+            'Type': '/Font',
+            'Subtype': '/Type0',
+            'BaseFont': '/' + font.name,
+            'Encoding': '/Identity-H',
+        })
+
+    def register(self, pdf):
+        pdf.add_object(self.dictionary)
+
+    def encode(self, text):
+        glyphs = []
+        for char in str(text):
+            gid = self.font.cmap.get(ord(char), 0)
+            self.used[gid] = char
+            glyphs.append(gid)
+        return b'<' + ''.join(f'{gid:04x}' for gid in glyphs).encode() + b'>'
+
+    def finish(self, pdf):
+        font = self.font
+        data = _subset_truetype(font, tuple(sorted(self.used)))
+        font_file = pydyf.Stream([data], {'Length1': len(data)}, compress=True)
+        pdf.add_object(font_file)
+
+        descriptor = pydyf.Dictionary({
+            'Type': '/FontDescriptor',
+            'FontName': '/' + font.name,
+            'Flags': 32,
+            'FontBBox': pydyf.Array(font.bbox),
+            'ItalicAngle': 0,
+            'Ascent': font.ascent,
+            'Descent': font.descent,
+            'CapHeight': font.ascent,
+            'StemV': 80,
+            'FontFile2': font_file.reference,
+        })
+        pdf.add_object(descriptor)
+
+        widths = pydyf.Array()
+        for gid in sorted(self.used):
+            widths.extend([gid, pydyf.Array([font.widths.get(gid, 0)])])
+        cid_font = pydyf.Dictionary({
+            'Type': '/Font',
+            'Subtype': '/CIDFontType2',
+            'BaseFont': '/' + font.name,
+            'CIDSystemInfo': pydyf.Dictionary({
+                'Registry': pydyf.String('Adobe'),
+                'Ordering': pydyf.String('Identity'),
+                'Supplement': 0,
+            }),
+            'FontDescriptor': descriptor.reference,
+            'W': widths,
+            'CIDToGIDMap': '/Identity',
+        })
+        pdf.add_object(cid_font)
+
+        to_unicode = pydyf.Stream([_to_unicode_cmap(self.used)], compress=True)
+        pdf.add_object(to_unicode)
+
+        self.dictionary['DescendantFonts'] = pydyf.Array([cid_font.reference])
+        self.dictionary['ToUnicode'] = to_unicode.reference
+
+
+class _LoadedFont:
+    def __init__(self, path):
+        from fontTools.ttLib import TTFont
+
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        tt = TTFont(BytesIO(self.data))
+        scale = 1000 / tt['head'].unitsPerEm
+        self.name = ''.join(c for c in tt['name'].getDebugName(6) or 'Embedded' if c.isalnum() or c == '-')
+        self.cmap = {code: tt.getGlyphID(glyph) for code, glyph in tt.getBestCmap().items()}
+        self.widths = {tt.getGlyphID(glyph): round(advance * scale)
+                       for glyph, (advance, _) in tt['hmtx'].metrics.items()}
+        head = tt['head']
+        self.bbox = [round(v * scale) for v in (head.xMin, head.yMin, head.xMax, head.yMax)]
+        self.ascent = round(tt['hhea'].ascent * scale)
+        self.descent = round(tt['hhea'].descent * scale)
+
+
+@lru_cache(maxsize=None)
+def _load_truetype(path):
+    return _LoadedFont(path)
+
+
+@lru_cache(maxsize=64)
+def _subset_truetype(font, gids):
+    """The font file with only the given glyphs, ids kept so Identity-H still addresses them."""
+    from fontTools import subset
+    from fontTools.ttLib import TTFont
+
+    options = subset.Options()
+    options.retain_gids = True
+    options.notdef_outline = True
+    options.layout_features = []
+    options.drop_tables += ['FFTM']
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(gids=gids)
+    tt = TTFont(BytesIO(font.data))
+    subsetter.subset(tt)
+    output = BytesIO()
+    tt.save(output)
+    return output.getvalue()
+
+
+def _to_unicode_cmap(used):
+    mappings = '\n'.join(f'<{gid:04x}> <{ord(char):04x}>' for gid, char in sorted(used.items())
+                         if ord(char) <= 0xFFFF)
+    return (
+        '/CIDInit /ProcSet findresource begin\n12 dict begin\nbegincmap\n'
+        '/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def\n'
+        '/CMapName /Adobe-Identity-UCS def\n/CMapType 2 def\n'
+        '1 begincodespacerange\n<0000> <ffff>\nendcodespacerange\n'
+        f'{len(used)} beginbfchar\n{mappings}\nendbfchar\n'
+        'endcmap\nCMapName currentdict /CMap defineresource pop\nend\nend'
+    ).encode()
+
+
+class _TableDocument:
+    """Paginated single-table document, header row repeated on every page."""
+
+    def __init__(self, font, title, column_widths, header):
+        self.font = font
+        self.title = title
+        self.column_widths = column_widths
+        self.header = header
+        self.pdf = pydyf.PDF()
+        self.font.register(self.pdf)
+        self.resources = pydyf.Dictionary({'Font': pydyf.Dictionary({'F1': self.font.dictionary.reference})})
+        self.pdf.add_object(self.resources)
+        self.stream = None
+        self.y = 0
+        self._new_page(with_title=True)
+
+    def add_row(self, cells, bold=False):
+        if self.y - ROW_HEIGHT < MARGIN:
+            self._new_page()
+        self.y -= ROW_HEIGHT
+        # content operators are formatted directly, pydyf's per-operator helpers dominate large tables
+        ops = []
+        x = MARGIN
+        for width in self.column_widths:
+            ops.append(f'{x:g} {self.y:g} {width:g} {ROW_HEIGHT} re')
+            x += width
+        ops.append('S')
+
+        x = MARGIN
+        text_y = self.y + (ROW_HEIGHT - FONT_SIZE) / 2 + 1
+        render_mode = '2 Tr ' if bold else ''
+        for index, (width, cell) in enumerate(zip(self.column_widths, cells)):
+            # only the first column holds free text, the rest are fixed-width values
+            isolated = index == 0 or bold
+            if isolated:
+                ops.append('q')
+            if index == 0:
+                ops.append(f'{x:g} {self.y:g} {width - CELL_PADDING:g} {ROW_HEIGHT} re W n')
+            ops.append(f'BT {render_mode}{x + CELL_PADDING:g} {text_y:g} Td')
+            self.stream.stream.append(' '.join(ops).encode() + b' ' + self.font.encode(cell) + b' Tj ET'
+                                      + (b' Q' if isolated else b''))
+            ops = []
+            x += width
+
+    def to_bytes(self):
+        self._finish_page()
+        self.font.finish(self.pdf)
+        output = BytesIO()
+        self.pdf.write(output, compress=True)
+        return output.getvalue()
+
+    def _new_page(self, with_title=False):
+        self._finish_page()
+        self.stream = pydyf.Stream(compress=True)
+        self.stream.set_line_width(0.5)
+        self.y = PAGE_HEIGHT - MARGIN
+        if with_title:
+            self.y -= TITLE_SIZE
+            self.stream.begin_text()
+            self.stream.set_font_size('F1', TITLE_SIZE)
+            self.stream.move_text_to(MARGIN, self.y)
+            self.stream.stream.append(self.font.encode(self.title) + b' Tj')
+            self.stream.end_text()
+            self.y -= TITLE_SIZE / 2
+        self.stream.set_font_size('F1', FONT_SIZE)
+        self.add_row(self.header, bold=True)
+
+    def _finish_page(self):
+        if self.stream is None:
+            return
+        self.pdf.add_object(self.stream)
+        self.pdf.add_page(pydyf.Dictionary({
+            'Type': '/Page',
+            'Parent': self.pdf.pages.reference,
+            'MediaBox': pydyf.Array([0, 0, PAGE_WIDTH, PAGE_HEIGHT]),
+            'Contents': self.stream.reference,
+            'Resources': self.resources.reference,
+        }))
+        self.stream = None
+
+
+RENDERERS = {
+    PydyfRenderer.name: lambda: PydyfRenderer(font_path=REPORT_FONT_PATH or None),
+    PdfkitRenderer.name: PdfkitRenderer,
+}
+
+
+@lru_cache(maxsize=None)
+def get_renderer(name=None):
+    name = name or REPORT_RENDERER
+    if name not in RENDERERS:
+        raise ValueError(f'Unknown report renderer {name}, expected one of {", ".join(RENDERERS)}')
+    return RENDERERS[name]()
+
+
+def render_monthly_events(rows, renderer_name=None):
+    """Module level entry point so renderers can run in worker processes."""
+    return get_renderer(renderer_name).monthly_events(rows)
@@ -0,0 +1,104 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from prometheus_client import Counter, Gauge
+from sqlalchemy import select
+from core.config import *
+from core.logger import logger
+from core.models import db, RevokedToken
+
+# the longest a token issued by generate_token stays valid
+TOKEN_LIFETIME = timedelta(hours=8)
+
+revoked_tokens_gauge = Gauge('revoked_tokens', 'Revoked token ids and users held in memory',
+                             multiprocess_mode='livemax')
+revoked_token_rejections_counter = Counter('revoked_token_rejections', 'Requests rejected with a revoked token')
+
+
+class RevocationList:
+    """
+    In-memory copy of the revoked_tokens table, lookups never touch the DB.
+    Rows are appended only, so every worker catches up at most once per sync_interval
+    by reading the rows created since the newest one it has seen, minus overlap seconds.
+    Ids or creation times don't become visible in order, a row committed later than a
+    newer one is still picked up as long as its transaction took less than the overlap.
+    """
+
+    def __init__(self, sync_interval, overlap=TOKEN_REVOCATION_SYNC_OVERLAP):
+        self.sync_interval = sync_interval
+        self.overlap = timedelta(seconds=overlap)
+        self.jtis = {}
+        self.users = {}
+        self.last_seen = None
+        self.next_sync = 0
+        self.lock = threading.Lock()
+
+    def is_revoked(self, claims):
+        if time.monotonic() >= self.next_sync:
+            self.sync(blocking=False)
+        revoked = claims.get('jti') in self.jtis or claims.get('iat', 0) < self.users.get(claims.get('user_id'), 0)
+        if revoked:
+            revoked_token_rejections_counter.inc()
+        return revoked
+
+    def sync(self, blocking=True):
+        # one thread syncs, the rest keep serving from the current copy
+        if not self.lock.acquire(blocking=blocking):
+            return
+        try:
+            now = datetime.utcnow()
+            query = select(RevokedToken.jti, RevokedToken.user_id, RevokedToken.revoked_before,
+                           RevokedToken.expires_at, RevokedToken.created_at).where(RevokedToken.expires_at > now)
+            if self.last_seen is not None:
+                query = query.where(RevokedToken.created_at >= self.last_seen - self.overlap)
+            # its own connection, a failed sync must not abort the transaction of the request that triggered it
+            with db.engine.connect() as connection:
+                rows = connection.execute(query).all()
+            for row in rows:
+                if row.jti is not None:
+                    self.jtis[row.jti] = row.expires_at
+                if row.user_id is not None:
+                    self.users[row.user_id] = max(self.users.get(row.user_id, 0), row.revoked_before)
+                if row.created_at is not None and (self.last_seen is None or row.created_at > self.last_seen):
+                    self.last_seen = row.created_at
+            self.jtis = {jti: expires_at for jti, expires_at in self.jtis.items() if expires_at > now}
+            # tokens issued before an older cutoff expired anyway
+            oldest = time.time() - TOKEN_LIFETIME.total_seconds()
+            self.users = {user_id: before for user_id, before in self.users.items() if before > oldest}
+            revoked_tokens_gauge.set(len(self.jtis) + len(self.users))
+        except Exception as ex:
+            logger.error(f'Token revocation sync failed: {ex}')
+        finally:
+            self.next_sync = time.monotonic() + self.sync_interval
+            self.lock.release()
+
+    def clear(self):
+        with self.lock:
+            self.jtis = {}
+            self.users = {}
+            self.last_seen = None
+            self.next_sync = 0
+
+
+revocation_list = RevocationList(TOKEN_REVOCATION_SYNC_INTERVAL)
+
+
+def _store(row, commit):
+    # revocations are rare, clean up rows of tokens that expired anyway on the way
+    RevokedToken.query.filter(RevokedToken.expires_at <= datetime.utcnow()).delete()
+    db.session.add(row)
+    if commit:
+        db.session.commit()
+        revocation_list.sync()
+
+
+def revoke_token(jti, expires_at, commit=True):
+    """Revokes a single token, e.g. on logout. With commit=False it's stored with the caller's transaction."""
+    _store(RevokedToken(jti=jti, expires_at=expires_at), commit)
+
+
+def revoke_user_tokens(user_id, commit=True):
+    """Revokes every token of the user issued until now."""
+    _store(RevokedToken(user_id=user_id, revoked_before=time.time(),
+                        expires_at=datetime.utcnow() + TOKEN_LIFETIME), commit)
+
@@ -1,8 +1,53 @@
+import json
+import logging
+import os
+import random
+import socketserver
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
-from core.token import *
-from core.util import generate_random_pass
-from app import app
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from unittest import mock
 
+from elasticsearch import Elasticsearch
+from flask import Blueprint, Flask, g, jsonify
+from flask_bcrypt import Bcrypt
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine, event as sa_event, inspect as sa_inspect, select
+
+import core.circuit as circuit_module
+import core.hashing as hashing
+import core.mailer as mailer
+from core.bulkhead import DeadlineExceeded, bounded_timeout, check_deadline, init_bulkheads, parse_settings, remaining
+from core.cache import TTLCache, LRUByteCache, cache_hits_counter, cache_misses_counter
+from core.circuit import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen, after_call, before_call, circuit
+from core.config import AUTH_BULK_MAX_ROWS, BCRYPT_LOG_ROUNDS, REPORT_FONT_PATH, REQUEST_DEADLINE, REQUEST_DEADLINES
+from core.database import engine_options, replica
+from core.jobs import JobQueue, QueueFull, SqliteJobStore, DONE, FAILED
+from core.logger import ElasticsearchHandler, log_records_dropped_counter
+from core.migrations import MIGRATIONS, migrate, migrate_command
+from core.models import db, Event, EventType, OutboxMessage, ProfileChange, RevokedToken, User
+from core.queries import events_fingerprint, event_type_titles, hours_by_event_type, invalidate_event_types, \
+    monthly_event_rows, profile_cache, profile_changes, record_profile_change
+from core.ratelimit import MemoryBackend, SqliteBackend, slide
+from core.renderer import get_renderer, render_monthly_events, PdfkitRenderer, PydyfRenderer, _StandardFont, \
+    _TableDocument, _TrueTypeFont, _load_truetype
+from core.revocation import TOKEN_LIFETIME, RevocationList, revocation_list, revoke_token, revoke_user_tokens
+from core.tokens import *
+from core.util import PASSWORD_WORDS, generate_random_pass, get_first_day_of_month, parse_date_range
+from services.auth import auth_bp, login_account_limiter, login_ip_limiter
+from services.health import health_bp
+from services.reports import build_grouped_monthly_events, build_monthly_events, pdf_response, reports_bp, \
+    rendered_reports
+from app import app, create_app
 
 class TestTokenFunctions(unittest.TestCase):
 
@@ -54,6 +99,37 @@ class TestTokenFunctions(unittest.TestCase):
         response = self.app.get('/v1/mock/token-admin-test')
         self.assertEqual(response.status_code, 401)
 
+    def test_verified_tokens_are_cached(self):
+        token_cache.invalidate()
+        token = generate_token(user_id=345, is_admin=False)
+        with mock.patch('core.tokens.jwt.decode', wraps=jwt.decode) as decode:
+            self.assertEqual(decode_token(token)['user_id'], 345)
+            self.assertEqual(decode_token(token)['user_id'], 345)
+            self.assertEqual(decode.call_count, 1)
+
+        tampered = {'Authorization': f'Bearer {token[:-2]}xx'}
+        self.assertEqual(self.app.get('/v1/mock/token-test', headers=tampered).status_code, 401)
+        self.assertEqual(self.app.get('/v1/mock/token-test', headers={'Authorization': 'Bearer junk'}).status_code, 401)
+
+    def test_cached_token_expires(self):
+        token = generate_token(user_id=345, is_admin=False, expiration_minutes=1)
+        claims = decode_token(token)
+        with mock.patch('core.tokens.time.time', return_value=claims['exp'] + 1), \
+                mock.patch('core.tokens.jwt.decode', side_effect=jwt.ExpiredSignatureError) as decode:
+            with self.assertRaises(jwt.ExpiredSignatureError):
+                decode_token(token)
+            decode.assert_called_once()
+
+    def test_claims_on_g(self):
+        @validate_token()
+        def handler(user_id):
+            return g.token_claims
+
+        with app.test_request_context(headers=self.admin_header):
+            claims = handler()
+        self.assertEqual(claims['user_id'], 123)
+        self.assertTrue(claims['is_admin'])
+
     def test_get_random_pass(self):
         for i in range(10):
             passwd = generate_random_pass()
@@ -61,6 +137,1225 @@ class TestTokenFunctions(unittest.TestCase):
             self.assertTrue(len(passwd) > 10)
             self.assertTrue(' ' not in passwd)
 
+    def test_random_pass_entropy(self):
+        self.assertGreater(len(PASSWORD_WORDS), 200)
+        with mock.patch('core.util.secrets.choice', side_effect=lambda words: 'Word') as choice:
+            self.assertEqual(generate_random_pass(word_count=2), 'WordWord')
+            self.assertEqual(generate_random_pass(word_count=2, min_entropy_bits=40), 'Word' * 6)
+            self.assertEqual(choice.call_count, 8)
+
+
+class TestReportRenderer(unittest.TestCase):
+
+    def test_pydyf_monthly_events(self):
+        start = datetime(2024, 1, 1, 8)
+        rows = [('Work', start + timedelta(hours=i), start + timedelta(hours=i + 1)) for i in range(200)]
+        pdf = PydyfRenderer().monthly_events(rows)
+        self.assertTrue(pdf.startswith(b'%PDF-'))
+        self.assertTrue(pdf.rstrip().endswith(b'%%EOF'))
+
+    def test_default_font_is_embedded_subset(self):
+        start = datetime(2024, 1, 1, 8)
+        renderer = get_renderer('pydyf')
+        self.assertEqual(renderer.font_path, REPORT_FONT_PATH)
+        pdf = renderer.monthly_events([('Počitnice', start, None)])
+        # only the used glyphs are embedded, not the whole font file
+        self.assertLess(len(pdf), os.path.getsize(REPORT_FONT_PATH) // 10)
+        self.assertNotEqual(_TrueTypeFont(_load_truetype(REPORT_FONT_PATH)).encode('č'), b'<0000>')
+
+    def test_table_pagination(self):
+        table = _TableDocument(_StandardFont(), 'Title', [300, 200], ['A', 'B'])
+        for i in range(200):
+            table.add_row([f'row {i}', str(i)])
+        table.to_bytes()
+        self.assertEqual(table.pdf.pages['Count'], 5)
+
+    def test_pydyf_grouped_events(self):
+        pdf = PydyfRenderer().grouped_events([(12.5, 'Work'), (.0, 'Sick (leave)')])
+        self.assertTrue(pdf.startswith(b'%PDF-'))
+
+    def test_get_renderer(self):
+        self.assertIsInstance(get_renderer('pydyf'), PydyfRenderer)
+        self.assertIsInstance(get_renderer('pdfkit'), PdfkitRenderer)
+        with self.assertRaises(ValueError):
+            get_renderer('unknown')
+
+
+class TestReportResponse(unittest.TestCase):
+
+    def test_small_pdf_is_sent_from_memory(self):
+        with app.test_request_context():
+            response = pdf_response(b'%PDF-small', 'report.pdf')
+            response.direct_passthrough = False
+            self.assertEqual(response.get_data(), b'%PDF-small')
+            self.assertEqual(response.content_length, len(b'%PDF-small'))
+            self.assertIn('report.pdf', response.headers['Content-Disposition'])
+
+    def test_large_pdf_is_streamed_in_chunks(self):
+        pdf = b'%PDF-' + b'x' * (REPORT_STREAM_THRESHOLD + 1)
+        with app.test_request_context():
+            response = pdf_response(pdf, 'report.pdf')
+            self.assertTrue(response.is_streamed)
+            self.assertIsNone(response.content_length)
+            self.assertEqual(response.get_data(), pdf)
+
+
+def create_sqlite_app():
+    sqlite_app = Flask(__name__)
+    sqlite_app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(sqlite_app)
+    return sqlite_app
+
+
+class TestReportQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = create_sqlite_app().app_context()
+        self.ctx.push()
+        db.create_all()
+        self.since = datetime(2024, 1, 1)
+        start = datetime(2024, 1, 1, 8)
+        events = [Event(user_id=1, event_type_id=i % 3 + 1, start_date=start + timedelta(hours=i),
+                        end_date=start + timedelta(hours=i, minutes=30 * (i % 4 + 1))) for i in range(3000)]
+        events.append(Event(user_id=2, event_type_id=1, start_date=start, end_date=start + timedelta(hours=5)))
+        events.append(Event(user_id=1, event_type_id=1, start_date=start - timedelta(days=1), end_date=start))
+        db.session.add_all(events)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_hours_by_event_type_sums_in_sql(self):
+        expected = {}
+        for event in Event.query.filter(Event.start_date >= self.since, Event.user_id == 1):
+            hours = (event.end_date - event.start_date).total_seconds() / 3600
+            expected[event.event_type_id] = expected.get(event.event_type_id, 0) + hours
+
+        grouped = hours_by_event_type(1, self.since)
+        self.assertEqual(len(grouped), 3)
+        for event_type_id, hours in expected.items():
+            self.assertAlmostEqual(grouped[event_type_id], hours, places=3)
+
+    def test_monthly_event_rows(self):
+        rows = monthly_event_rows(1, self.since)
+        self.assertEqual(len(rows), 3000)
+        self.assertEqual(rows[0].start_date, datetime(2024, 1, 1, 8))
+        self.assertEqual(len(rows[0]), 3)
+
+    def test_fingerprint_tracks_types_and_times(self):
+        fingerprint = events_fingerprint(1, self.since)
+        event = Event.query.filter_by(user_id=1).order_by(Event.id).first()
+        event.event_type_id = 3 if event.event_type_id != 3 else 1
+        db.session.commit()
+        self.assertNotEqual(events_fingerprint(1, self.since), fingerprint)
+
+        fingerprint = events_fingerprint(1, self.since)
+        # an older event moved, keeping its duration
+        event.start_date += timedelta(minutes=5)
+        event.end_date += timedelta(minutes=5)
+        db.session.commit()
+        self.assertNotEqual(events_fingerprint(1, self.since), fingerprint)
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_expiry_and_invalidation(self):
+        cache = TTLCache('test_expiry', ttl=10)
+        with mock.patch('core.cache.time.monotonic', return_value=100):
+            cache.set('a', 1)
+            self.assertEqual(cache.get('a'), 1)
+        with mock.patch('core.cache.time.monotonic', return_value=111):
+            self.assertIsNone(cache.get('a'))
+
+        cache.set('b', 2)
+        cache.invalidate('b')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache_hits_counter.labels('test_expiry')._value.get(), 1)
+        self.assertEqual(cache_misses_counter.labels('test_expiry')._value.get(), 2)
+
+    def test_lru_eviction(self):
+        cache = TTLCache('test_lru', ttl=60, maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+
+
+class TestLRUByteCache(unittest.TestCase):
+
+    def test_size_bound(self):
+        cache = LRUByteCache('test_bytes', max_bytes=10)
+        cache.set('a', b'1234')
+        cache.set('b', b'1234')
+        cache.get('a')
+        cache.set('c', b'1234')
+        self.assertEqual(cache.size, 8)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'1234')
+        cache.set('d', b'x' * 11)
+        self.assertIsNone(cache.get('d'))
+
+
+class TestEventTypeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = create_sqlite_app().app_context()
+        self.ctx.push()
+        db.create_all()
+        db.session.add_all([EventType(id=1, title='Work'), EventType(id=2, title='Vacation')])
+        db.session.commit()
+        invalidate_event_types()
+
+    def tearDown(self):
+        invalidate_event_types()
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_steady_state_has_no_round_trips(self):
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        sa_event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            for _ in range(5):
+                self.assertEqual(event_type_titles(), {1: 'Work', 2: 'Vacation'})
+        finally:
+            sa_event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(len(statements), 1)
+
+    def test_refresh_picks_up_new_types(self):
+        event_type_titles()
+        db.session.add(EventType(id=3, title='Sick leave'))
+        db.session.commit()
+        self.assertNotIn(3, event_type_titles())
+        self.assertEqual(event_type_titles(refresh=True)[3], 'Sick leave')
+
+    def test_unknown_types_reload_once(self):
+        start = get_first_day_of_month() + timedelta(hours=8)
+        db.session.add_all([Event(user_id=1, event_type_id=event_type_id, start_date=start,
+                                  end_date=start + timedelta(hours=2)) for event_type_id in (1, None, 99, 99)])
+        db.session.commit()
+        with mock.patch('core.queries.event_type_titles', wraps=event_type_titles) as titles, \
+                mock.patch('services.reports.get_renderer') as renderer:
+            build_monthly_events(1)
+            rows = list(renderer.return_value.monthly_events.call_args.args[0])
+            self.assertEqual([row[0] for row in rows], ['Work', 'Unknown', 'Unknown', 'Unknown'])
+            self.assertEqual(titles.call_count, 2)
+
+            build_grouped_monthly_events(1)
+            self.assertEqual(renderer.return_value.grouped_events.call_args.args[0],
+                             [(6.0, 'Unknown'), (2.0, 'Work'), (0.0, 'Vacation')])
+
+
+class TestReports(unittest.TestCase):
+
+    def setUp(self):
+        sqlite_app = create_sqlite_app()
+        sqlite_app.register_blueprint(reports_bp)
+        self.client = sqlite_app.test_client()
+        self.ctx = sqlite_app.app_context()
+        self.ctx.push()
+        db.create_all()
+        start = get_first_day_of_month() + timedelta(hours=8)
+        db.session.add(EventType(id=1, title='Work'))
+        db.session.add_all([Event(user_id=7, event_type_id=1, start_date=start + timedelta(days=i),
+                                  end_date=start + timedelta(days=i, hours=8)) for i in range(20)])
+        db.session.commit()
+        self.headers = {'Authorization': f'Bearer {generate_token(user_id=7, is_admin=False)}'}
+
+    def tearDown(self):
+        invalidate_event_types()
+        rendered_reports.invalidate()
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def wait_for(self, job_id, headers):
+        for _ in range(100):
+            response = self.client.get(f'/v1/reports/jobs/{job_id}', headers=headers)
+            if response.json['status'] in (DONE, FAILED):
+                return response
+            time.sleep(.05)
+        self.fail('Report job did not finish')
+
+    def test_async_report_job(self):
+        response = self.client.get('/v1/reports/grouped-monthly-events?async=true', headers=self.headers)
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json['job_id']
+
+        self.assertEqual(self.wait_for(job_id, self.headers).json['status'], DONE)
+        response = self.client.get(f'/v1/reports/jobs/{job_id}/download', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data.startswith(b'%PDF-'))
+
+        other_user = {'Authorization': f'Bearer {generate_token(user_id=8, is_admin=False)}'}
+        response = self.client.get(f'/v1/reports/jobs/{job_id}/download', headers=other_user)
+        self.assertEqual(response.status_code, 404)
+
+    def test_report_etag(self):
+        response = self.client.get('/v1/reports/monthly-events', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+
+        response = self.client.get('/v1/reports/monthly-events', headers={**self.headers, 'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(rendered_reports), 1)
+
+        start = get_first_day_of_month() + timedelta(days=25)
+        db.session.add(Event(user_id=7, event_type_id=1, start_date=start, end_date=start + timedelta(hours=1)))
+        db.session.commit()
+        response = self.client.get('/v1/reports/monthly-events', headers={**self.headers, 'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_batch_monthly_events_zip(self):
+        db.session.add_all([User(id=7, gmail='a@test.com', password='x'), User(id=9, gmail='b@test.com', password='x')])
+        db.session.commit()
+        admin = {'Authorization': f'Bearer {generate_token(user_id=1, is_admin=True)}'}
+
+        response = self.client.get('/v1/reports/batch/monthly-events', headers=self.headers)
+        self.assertEqual(response.status_code, 403)
+
+        response = self.client.get('/v1/reports/batch/monthly-events', headers=admin)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        archive = zipfile.ZipFile(BytesIO(response.data))
+        self.assertEqual(archive.namelist(), ['7-a@test.com-monthly-events.pdf', '9-b@test.com-monthly-events.pdf'])
+        self.assertIsNone(archive.testzip())
+        self.assertTrue(archive.read('7-a@test.com-monthly-events.pdf').startswith(b'%PDF-'))
+
+    def test_batch_monthly_events_with_open_event(self):
+        start = get_first_day_of_month() + timedelta(hours=8)
+        db.session.add_all([User(id=7, gmail='a@test.com', password='x'), User(id=9, gmail='b@test.com', password='x'),
+                            Event(user_id=9, event_type_id=1, start_date=start, end_date=None)])
+        db.session.commit()
+        admin = {'Authorization': f'Bearer {generate_token(user_id=1, is_admin=True)}'}
+
+        response = self.client.get('/v1/reports/batch/monthly-events', headers=admin)
+        archive = zipfile.ZipFile(BytesIO(response.data))
+        self.assertEqual(archive.namelist(), ['7-a@test.com-monthly-events.pdf', '9-b@test.com-monthly-events.pdf'])
+        self.assertIsNone(archive.testzip())
+        self.assertTrue(archive.read('9-b@test.com-monthly-events.pdf').startswith(b'%PDF-'))
+
+    def test_batch_monthly_events_skips_failed_user(self):
+        db.session.add_all([User(id=7, gmail='a@test.com', password='x'), User(id=9, gmail='b@test.com', password='x')])
+        db.session.add(Event(user_id=9, event_type_id=1, start_date=get_first_day_of_month(), end_date=None))
+        db.session.commit()
+        admin = {'Authorization': f'Bearer {generate_token(user_id=1, is_admin=True)}'}
+
+        def render(rows, renderer_name):
+            if len(rows) == 1:
+                raise ValueError('broken document')
+            return render_monthly_events(rows, renderer_name)
+
+        with ThreadPoolExecutor(max_workers=1) as pool, \
+                mock.patch('services.reports.get_batch_render_pool', return_value=pool), \
+                mock.patch('services.reports.render_monthly_events', side_effect=render):
+            response = self.client.get('/v1/reports/batch/monthly-events', headers=admin)
+            archive = zipfile.ZipFile(BytesIO(response.data))
+        self.assertEqual(archive.namelist(), ['7-a@test.com-monthly-events.pdf'])
+        self.assertIsNone(archive.testzip())
+
+    def test_export_csv_and_ndjson(self):
+        start = get_first_day_of_month() + timedelta(hours=8)
+        query = f'from={(start + timedelta(days=2)).isoformat()}&to={(start + timedelta(days=5)).isoformat()}'
+
+        response = self.client.get(f'/v1/reports/export/monthly-events?{query}', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/csv')
+        lines = response.data.decode().splitlines()
+        self.assertEqual(lines[0], 'id,event_type_id,event_type,start_date,end_date,hours')
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[1].endswith(',Work,' + (start + timedelta(days=2)).isoformat() + ','
+                                          + (start + timedelta(days=2, hours=8)).isoformat() + ',8.0'))
+
+        response = self.client.get(f'/v1/reports/export/grouped-monthly-events?format=ndjson&{query}',
+                                   headers=self.headers)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        rows = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual(rows, [{'event_type_id': 1, 'event_type': 'Work', 'hours': 24.0}])
+
+        response = self.client.get('/v1/reports/export/monthly-events?format=xml', headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/v1/reports/export/monthly-events?from=yesterday', headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+        # an offset on one end only, compared with the naive default of the other
+        to = (get_first_day_of_month() + timedelta(days=40)).isoformat() + '+02:00'
+        response = self.client.get('/v1/reports/export/monthly-events', query_string={'to': to}, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(parse_date_range({'from': '2024-01-01T02:00:00+02:00', 'to': '2024-01-02'}),
+                         (datetime(2024, 1, 1), datetime(2024, 1, 2)))
+
+    def test_queue_is_bounded(self):
+        queue = JobQueue('test_bounded', max_workers=1, max_pending=1, result_ttl=60)
+        release = threading.Event()
+        queue.submit(1, release.wait)
+        with self.assertRaises(QueueFull):
+            queue.submit(1, release.wait)
+        release.set()
+        queue.shutdown()
+
+    def test_jobs_visible_to_other_workers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'jobs.db')
+            queue = JobQueue('test_shared', max_workers=1, max_pending=1, result_ttl=60, store=SqliteJobStore(path))
+            job = queue.submit(1, lambda: b'%PDF', download_name='report.pdf')
+            queue.shutdown()
+            # the queue of another worker process polling the same file
+            other = JobQueue('test_shared', max_workers=1, max_pending=1, result_ttl=60, store=SqliteJobStore(path))
+            found = other.get(job.id, owner=1)
+            self.assertEqual((found.status, found.result, found.download_name), (DONE, b'%PDF', 'report.pdf'))
+            self.assertIsNone(other.get(job.id, owner=2))
+            with mock.patch('core.jobs.time.time', return_value=time.time() + 61):
+                self.assertIsNone(other.get(job.id))
+            queue.store.close()
+            other.store.close()
+
+
+class TestPasswordHashing(unittest.TestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        hashing.shutdown_hash_pool()
+
+    def test_hash_and_check(self):
+        pw_hash = hashing.hash_password('secret-password', rounds=4)
+        self.assertTrue(pw_hash.startswith('$2b$04$'))
+        self.assertTrue(hashing.check_password(pw_hash, 'secret-password'))
+        self.assertFalse(hashing.check_password(pw_hash, 'wrong-password'))
+        self.assertFalse(hashing.check_password(pw_hash, ''))
+
+    def test_compatible_with_flask_bcrypt(self):
+        pw_hash = Bcrypt().generate_password_hash('secret-password', 4).decode('utf-8')
+        self.assertTrue(hashing.check_password(pw_hash, 'secret-password'))
+
+    def test_hash_batch(self):
+        hashes = hashing.hash_passwords(['first-password', 'second-password'], rounds=4)
+        self.assertTrue(hashing.check_password(hashes[0], 'first-password'))
+        self.assertTrue(hashing.check_password(hashes[1], 'second-password'))
+
+    def test_rejects_when_saturated(self):
+        slots = threading.BoundedSemaphore(1)
+        slots.acquire()
+        with mock.patch.object(hashing, 'hash_slots', slots), \
+                mock.patch.object(hashing, 'PASSWORD_HASH_QUEUE_TIMEOUT', .01):
+            with self.assertRaises(hashing.HashingBusy):
+                hashing.hash_password('secret-password', rounds=4)
+
+    def test_slot_held_until_pool_finishes_after_deadline(self):
+        hashing.hash_password('warm-up', rounds=4)
+        slots = threading.BoundedSemaphore(1)
+        with mock.patch.object(hashing, 'hash_slots', slots), Flask(__name__).test_request_context():
+            g.deadline = time.monotonic() + .05
+            with self.assertRaises(DeadlineExceeded):
+                hashing.hash_password('secret-password', rounds=13)
+            # the caller gave up, the pool is still busy with its hash
+            self.assertFalse(slots.acquire(blocking=False))
+            self.assertTrue(slots.acquire(timeout=10))
+
+
+class FakeElasticsearch(BaseHTTPRequestHandler):
+    bulk_requests = []
+    release = threading.Event()
+
+    def do_PUT(self):
+        assert self.path.startswith('/_bulk')
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        FakeElasticsearch.release.wait(5)
+        lines = [json.loads(line) for line in body.decode().splitlines() if line]
+        FakeElasticsearch.bulk_requests.append(lines[1::2])
+        payload = json.dumps({'took': 1, 'errors': False, 'items': []}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_POST = do_PUT
+
+    def log_message(self, *args):
+        pass
+
+
+class TestElasticsearchHandler(unittest.TestCase):
+
+    def setUp(self):
+        FakeElasticsearch.bulk_requests = []
+        FakeElasticsearch.release.set()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeElasticsearch)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.es = Elasticsearch(f'http://127.0.0.1:{self.server.server_port}')
+
+    def tearDown(self):
+        FakeElasticsearch.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_logger(self, handler):
+        test_logger = logging.getLogger(f'test-es-{id(handler)}')
+        test_logger.propagate = False
+        test_logger.addHandler(handler)
+        return test_logger
+
+    def test_records_are_shipped_in_bulk(self):
+        handler = ElasticsearchHandler(self.es, 'test_logs', batch_size=10, flush_interval=60)
+        test_logger = self.make_logger(handler)
+        for i in range(25):
+            test_logger.warning(f'message {i}')
+        handler.close()
+
+        messages = [doc['message'] for batch in FakeElasticsearch.bulk_requests for doc in batch]
+        self.assertEqual(messages, [f'message {i}' for i in range(25)])
+        self.assertEqual([len(batch) for batch in FakeElasticsearch.bulk_requests], [10, 10, 5])
+
+    def test_client_is_created_on_first_send(self):
+        factory = mock.Mock(return_value=self.es)
+        handler = ElasticsearchHandler(factory, 'test_logs', batch_size=10, flush_interval=60)
+        test_logger = self.make_logger(handler)
+        factory.assert_not_called()
+
+        test_logger.warning('first')
+        test_logger.warning('second')
+        handler.close()
+        factory.assert_called_once_with()
+        self.assertEqual(len(FakeElasticsearch.bulk_requests[0]), 2)
+
+    def test_overflow_drops_records_without_blocking(self):
+        FakeElasticsearch.release.clear()
+        dropped = log_records_dropped_counter.labels('overflow')._value.get()
+        handler = ElasticsearchHandler(self.es, 'test_logs', queue_size=5, batch_size=1, flush_interval=60)
+        test_logger = self.make_logger(handler)
+
+        started = time.perf_counter()
+        for i in range(20):
+            test_logger.warning(f'message {i}')
+        self.assertLess(time.perf_counter() - started, 1)
+        self.assertGreaterEqual(log_records_dropped_counter.labels('overflow')._value.get() - dropped, 14)
+
+        FakeElasticsearch.release.set()
+        handler.close()
+
+
+class FakeSMTP(socketserver.StreamRequestHandler):
+    messages = []
+    sessions = 0
+    fail_next = 0
+
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def handle(self):
+        FakeSMTP.sessions += 1
+        self.reply('220 localhost fake smtp')
+        while True:
+            line = self.rfile.readline().decode().strip()
+            command = line.split(' ')[0].upper()
+            if not line or command == 'QUIT':
+                self.reply('221 bye')
+                return
+            if command == 'EHLO':
+                self.reply('250-localhost')
+                self.reply('250 AUTH PLAIN')
+            elif command == 'AUTH':
+                self.reply('235 authenticated')
+            elif command == 'RCPT' and FakeSMTP.fail_next:
+                FakeSMTP.fail_next -= 1
+                self.reply('451 try again later')
+            elif command == 'DATA':
+                self.reply('354 go ahead')
+                data = []
+                for data_line in iter(self.rfile.readline, b'.\r\n'):
+                    data.append(data_line.decode())
+                FakeSMTP.messages.append(''.join(data))
+                self.reply('250 queued')
+            else:
+                self.reply('250 ok')
+
+
+class TestMailOutbox(unittest.TestCase):
+
+    def setUp(self):
+        FakeSMTP.messages = []
+        FakeSMTP.sessions = 0
+        FakeSMTP.fail_next = 0
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), FakeSMTP)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.patches = [mock.patch.multiple(mailer, SMTP_HOST='127.0.0.1', SMTP_PORT=self.server.server_address[1],
+                                            SMTP_STARTTLS=False, SMTP_SENDER='team@workclock.test',
+                                            SMTP_PASSWORD='secret', MAIL_RETRY_BACKOFF=0)]
+        for patch in self.patches:
+            patch.start()
+
+        self.ctx = create_sqlite_app().app_context()
+        self.ctx.push()
+        db.create_all()
+        self.sender = mailer.MailSender()
+
+    def tearDown(self):
+        self.sender.stop()
+        for patch in self.patches:
+            patch.stop()
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_messages_share_one_smtp_session(self):
+        for i in range(3):
+            mailer.send_email(f'user{i}@test.com', 'Welcome', f'Hello {i}', commit=False)
+        db.session.commit()
+
+        self.sender.send_pending()
+        self.assertEqual(len(FakeSMTP.messages), 3)
+        self.assertEqual(FakeSMTP.sessions, 1)
+        self.assertIn('Subject: Welcome', FakeSMTP.messages[0])
+        self.assertEqual(OutboxMessage.query.filter(OutboxMessage.sent_at.is_(None)).count(), 0)
+        self.assertEqual({message.content for message in OutboxMessage.query}, {''})
+
+    def test_failed_delivery_is_retried(self):
+        FakeSMTP.fail_next = 1
+        mailer.send_email('user@test.com', 'Welcome', 'Hello', commit=False)
+        db.session.commit()
+
+        self.sender.send_pending()
+        message = OutboxMessage.query.one()
+        self.assertIsNone(message.sent_at)
+        self.assertEqual(message.attempts, 1)
+        self.assertEqual(message.content, 'Hello')
+
+        self.sender.send_pending()
+        self.assertIsNotNone(OutboxMessage.query.one().sent_at)
+        self.assertEqual(len(FakeSMTP.messages), 1)
+
+
+class TestBulkRegister(unittest.TestCase):
+
+    def setUp(self):
+        sqlite_app = create_sqlite_app()
+        sqlite_app.register_blueprint(auth_bp)
+        self.client = sqlite_app.test_client()
+        self.ctx = sqlite_app.app_context()
+        self.ctx.push()
+        db.create_all()
+        db.session.add(User(name='Existing', gmail='existing@test.com', password='x'))
+        db.session.commit()
+        self.headers = {'Authorization': f'Bearer {generate_token(user_id=1, is_admin=True)}'}
+        self.patches = [mock.patch.object(hashing, 'BCRYPT_LOG_ROUNDS', 4),
+                        mock.patch.object(mailer, 'SMTP_SENDER', 'team@workclock.test'),
+                        mock.patch.object(mailer.mail_sender, 'wake')]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_max_rows_fit_the_deadline(self):
+        deadline = parse_settings(REQUEST_DEADLINES, float).get('auth.register_bulk', REQUEST_DEADLINE)
+        started = time.perf_counter()
+        hashing._hash('password', BCRYPT_LOG_ROUNDS)
+        cost = time.perf_counter() - started
+        # worst case, a single hashing process works through every row
+        self.assertLess(AUTH_BULK_MAX_ROWS * cost, deadline)
+
+    @classmethod
+    def tearDownClass(cls):
+        hashing.shutdown_hash_pool()
+
+    def test_json_rows(self):
+        response = self.client.post('/v1/auth/register/bulk', headers=self.headers, json=[
+            {'name': 'Anna', 'gmail': 'anna@test.com', 'is_admin': True},
+            {'name': 'Old', 'gmail': 'existing@test.com'},
+            {'name': 'Anna again', 'gmail': 'anna@test.com'},
+            {'gmail': 'noname@test.com'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['summary'], {'created': 1, 'conflict': 1, 'duplicate': 1, 'invalid': 1})
+        self.assertEqual([result['status'] for result in response.json['results']],
+                         ['created', 'conflict', 'duplicate', 'invalid'])
+
+        anna = User.query.filter_by(gmail='anna@test.com').one()
+        self.assertEqual(response.json['results'][0]['id'], anna.id)
+        self.assertTrue(anna.is_admin)
+        self.assertTrue(anna.password.startswith('$2b$04$'))
+        self.assertEqual(OutboxMessage.query.one().receiver, 'anna@test.com')
+
+    def test_csv_upload(self):
+        body = 'name,gmail,is_admin\nBen,ben@test.com,false\nCid,cid@test.com,true\n'
+        response = self.client.post('/v1/auth/register/bulk', headers=self.headers,
+                                    data={'file': (BytesIO(body.encode()), 'users.csv')})
+        self.assertEqual(response.json['summary']['created'], 2)
+        self.assertFalse(User.query.filter_by(gmail='ben@test.com').one().is_admin)
+        self.assertTrue(User.query.filter_by(gmail='cid@test.com').one().is_admin)
+        self.assertEqual(OutboxMessage.query.count(), 2)
+
+    def test_rejects_non_admin_and_bad_body(self):
+        user_headers = {'Authorization': f'Bearer {generate_token(user_id=2, is_admin=False)}'}
+        self.assertEqual(self.client.post('/v1/auth/register/bulk', headers=user_headers, json=[]).status_code, 403)
+        self.assertEqual(self.client.post('/v1/auth/register/bulk', headers=self.headers,
+                                          json={'gmail': 'a@test.com'}).status_code, 400)
+
+    def test_wrong_field_types_are_row_errors(self):
+        response = self.client.post('/v1/auth/register/bulk', headers=self.headers, json=[
+            {'name': 'Dan', 'gmail': 123},
+            {'name': ['Eve'], 'gmail': 'eve@test.com'},
+            {'name': 'Fay', 'gmail': 'fay@test.com', 'is_admin': {}},
+            {'name': 'Gus', 'gmail': 'gus@test.com'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['status'] for result in response.json['results']],
+                         ['invalid', 'invalid', 'invalid', 'created'])
+        self.assertEqual(response.json['results'][0]['gmail'], 123)
+
+
+class TestUserListing(unittest.TestCase):
+
+    def setUp(self):
+        sqlite_app = create_sqlite_app()
+        sqlite_app.register_blueprint(auth_bp)
+        self.client = sqlite_app.test_client()
+        self.ctx = sqlite_app.app_context()
+        self.ctx.push()
+        db.create_all()
+        db.session.add_all([User(name=f'User {i}', gmail=f'user{i}@test.com', password='hash') for i in range(5)])
+        db.session.commit()
+        self.headers = {'Authorization': f'Bearer {generate_token(user_id=1, is_admin=True)}'}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_keyset_pages(self):
+        ids, cursor = [], None
+        for _ in range(3):
+            query = '?limit=2' + (f'&after_id={cursor}' if cursor else '')
+            response = self.client.get(f'/v1/auth/all{query}', headers=self.headers)
+            ids += [user['id'] for user in response.json['users']]
+            cursor = response.json['next_cursor']
+        self.assertEqual(ids, [1, 2, 3, 4, 5])
+        self.assertIsNone(cursor)
+        self.assertNotIn('password', response.json['users'][0])
+
+    def test_fields_and_stream(self):
+        response = self.client.get('/v1/auth/all?stream=true&after_id=3&fields=gmail', headers=self.headers)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line) for line in response.get_data(as_text=True).splitlines()],
+                         [{'id': 4, 'gmail': 'user3@test.com'}, {'id': 5, 'gmail': 'user4@test.com'}])
+
+        self.assertEqual(self.client.get('/v1/auth/all?fields=password', headers=self.headers).status_code, 400)
+        self.assertEqual(self.client.get('/v1/auth/all?limit=5000', headers=self.headers).status_code, 400)
+        response = self.client.get('/v1/auth/all?stream=1&fields=gmail', headers=self.headers)
+        self.assertEqual(len(response.get_data(as_text=True).splitlines()), 5)
+
+    def test_whole_list_without_limit_or_cursor(self):
+        with mock.patch('services.auth.AUTH_USERS_PAGE_SIZE', 2):
+            response = self.client.get('/v1/auth/all', headers=self.headers)
+            self.assertTrue(response.is_streamed)
+            self.assertEqual([user['id'] for user in response.json['users']], [1, 2, 3, 4, 5])
+            self.assertIsNone(response.json['next_cursor'])
+            response = self.client.get('/v1/auth/all?after_id=1', headers=self.headers)
+            self.assertEqual([user['id'] for user in response.json['users']], [2, 3])
+
+
+class TestTokenRevocation(unittest.TestCase):
+
+    def setUp(self):
+        sqlite_app = create_sqlite_app()
+        sqlite_app.register_blueprint(auth_bp)
+        self.client = sqlite_app.test_client()
+        self.ctx = sqlite_app.app_context()
+        self.ctx.push()
+        db.create_all()
+        db.session.add_all([User(id=1, name='Admin', gmail='admin@test.com', password='hash', is_admin=True),
+                            User(id=2, name='User', gmail='user@test.com', password='hash')])
+        db.session.commit()
+        revocation_list.clear()
+        self.admin_headers = {'Authorization': f'Bearer {generate_token(user_id=1, is_admin=True)}'}
+        self.user_headers = {'Authorization': f'Bearer {generate_token(user_id=2, is_admin=False)}'}
+
+    def tearDown(self):
+        revocation_list.clear()
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_logout_revokes_only_that_token(self):
+        other_headers = {'Authorization': f'Bearer {generate_token(user_id=2, is_admin=False)}'}
+        self.assertEqual(self.client.post('/v1/auth/logout', headers=self.user_headers).status_code, 200)
+        self.assertEqual(self.client.get('/v1/auth/profile', headers=self.user_headers).status_code, 401)
+        self.assertEqual(self.client.get('/v1/auth/profile', headers=other_headers).status_code, 200)
+
+    def test_removed_user_tokens_are_revoked(self):
+        response = self.client.delete('/v1/auth/remove-user?id=2', headers=self.admin_headers)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/v1/auth/profile', headers=self.user_headers)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json['message'], 'Token has been revoked')
+
+    def test_other_workers_sync_incrementally(self):
+        worker = RevocationList(sync_interval=60)
+        claims = decode_token(self.user_headers['Authorization'][7:])
+        self.assertFalse(worker.is_revoked(claims))
+
+        revoke_token(claims['jti'], datetime.utcfromtimestamp(claims['exp']))
+        revoke_user_tokens(1)
+        with mock.patch.object(db.engine, 'connect', side_effect=AssertionError('no DB query expected')):
+            self.assertFalse(worker.is_revoked(claims))
+
+        worker.sync()
+        self.assertTrue(worker.is_revoked(claims))
+        self.assertTrue(worker.is_revoked({'user_id': 1, 'iat': claims['iat']}))
+        self.assertFalse(worker.is_revoked({'user_id': 1, 'iat': time.time() + 1}))
+
+    def test_late_commits_are_not_skipped(self):
+        worker = RevocationList(sync_interval=60, overlap=60)
+        revoke_token('newer', datetime.utcnow() + timedelta(hours=1))
+        worker.sync()
+        # a row that got its id and creation time before the one above but committed after it
+        db.session.add(RevokedToken(id=0, jti='older', expires_at=datetime.utcnow() + timedelta(hours=1),
+                                    created_at=worker.last_seen - timedelta(seconds=30)))
+        db.session.commit()
+        worker.sync()
+        self.assertTrue(worker.is_revoked({'jti': 'older'}))
+
+    def test_failed_sync_leaves_session_usable(self):
+        worker = RevocationList(sync_interval=60)
+        worker.users[3] = time.time() - TOKEN_LIFETIME.total_seconds() - 1
+        with mock.patch.object(db.engine, 'connect', side_effect=Exception('connection lost')):
+            self.assertFalse(worker.is_revoked({'user_id': 2, 'iat': time.time()}))
+        self.assertEqual(User.query.count(), 2)
+        worker.sync()
+        self.assertEqual(worker.users, {})
+
+
+class TestProfileCache(unittest.TestCase):
+
+    def setUp(self):
+        sqlite_app = create_sqlite_app()
+        sqlite_app.register_blueprint(auth_bp)
+        self.client = sqlite_app.test_client()
+        self.ctx = sqlite_app.app_context()
+        self.ctx.push()
+        db.create_all()
+        db.session.add_all([User(id=1, name='Admin', gmail='admin@test.com', password='hash', is_admin=True),
+                            User(id=2, name='User', gmail='user@test.com', password='hash', is_admin=False)])
+        db.session.commit()
+        profile_cache.invalidate()
+        profile_changes.clear()
+        self.admin_headers = {'Authorization': f'Bearer {generate_token(user_id=1, is_admin=True)}'}
+        self.user_headers = {'Authorization': f'Bearer {generate_token(user_id=2, is_admin=False)}'}
+
+    def tearDown(self):
+        profile_cache.invalidate()
+        profile_changes.clear()
+        revocation_list.clear()
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_profile_served_from_cache_with_etag(self):
+        response = self.client.get('/v1/auth/profile', headers=self.user_headers)
+        self.assertEqual(response.json, {'id': 2, 'gmail': 'user@test.com', 'name': 'User', 'is_admin': False})
+        etag = response.headers['ETag']
+
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        sa_event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            response = self.client.get('/v1/auth/profile', headers={**self.user_headers, 'If-None-Match': etag})
+        finally:
+            sa_event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(statements, [])
+
+    def test_writes_invalidate(self):
+        self.client.get('/v1/auth/profile', headers=self.user_headers)
+        self.client.post('/v1/auth/profile', headers=self.user_headers, json={'name': 'Renamed'})
+        self.assertEqual(self.client.get('/v1/auth/profile', headers=self.user_headers).json['name'], 'Renamed')
+
+        self.client.post('/v1/auth/user?id=2', headers=self.admin_headers, json={'name': 'By admin'})
+        self.assertEqual(self.client.get('/v1/auth/user?id=2', headers=self.admin_headers).json['name'], 'By admin')
+
+        self.client.delete('/v1/auth/remove-user?id=2', headers=self.admin_headers)
+        self.assertEqual(self.client.get('/v1/auth/user?id=2', headers=self.admin_headers).status_code, 404)
+
+    def test_other_workers_drop_changed_profiles(self):
+        self.client.get('/v1/auth/profile', headers=self.user_headers)
+        # the writes land on another worker, this one only learns about them through the sync
+        with mock.patch('services.auth.store_profile'), mock.patch('services.auth.invalidate_profile'):
+            self.client.post('/v1/auth/profile', headers=self.user_headers, json={'name': 'Renamed'})
+            self.assertEqual(self.client.get('/v1/auth/profile', headers=self.user_headers).json['name'], 'User')
+            profile_changes.sync()
+            self.assertEqual(self.client.get('/v1/auth/profile', headers=self.user_headers).json['name'], 'Renamed')
+
+            self.client.get('/v1/auth/user?id=2', headers=self.admin_headers)
+            self.client.delete('/v1/auth/remove-user?id=2', headers=self.admin_headers)
+            profile_changes.sync()
+            self.assertEqual(self.client.get('/v1/auth/user?id=2', headers=self.admin_headers).status_code, 404)
+
+    def test_old_profile_changes_are_pruned(self):
+        db.session.add(ProfileChange(user_id=1, created_at=datetime.utcnow() - timedelta(days=1)))
+        db.session.add(ProfileChange(user_id=1, created_at=datetime.utcnow()))
+        db.session.commit()
+        record_profile_change(2)
+        db.session.commit()
+        self.assertEqual(sorted(change.user_id for change in ProfileChange.query), [1, 2])
+
+
+class TestDatabaseRouting(unittest.TestCase):
+
+    def setUp(self):
+        sqlite_app = Flask(__name__)
+        sqlite_app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        sqlite_app.config['SQLALCHEMY_BINDS'] = {'replica': 'sqlite://'}
+        db.init_app(sqlite_app)
+        sqlite_app.register_blueprint(auth_bp)
+        self.client = sqlite_app.test_client()
+        self.ctx = sqlite_app.app_context()
+        self.ctx.push()
+        db.create_all()
+        db.metadata.create_all(db.engines['replica'])
+        db.session.add(User(id=1, name='Primary', gmail='user@test.com', password='hash'))
+        db.session.commit()
+        with db.engines['replica'].begin() as connection:
+            connection.execute(User.__table__.insert().values(id=1, name='Replica', gmail='user@test.com',
+                                                              password='hash'))
+        profile_cache.invalidate()
+        self.headers = {'Authorization': f'Bearer {generate_token(user_id=1, is_admin=False)}'}
+
+    def tearDown(self):
+        profile_cache.invalidate()
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        # init_app registers a metadata per configured bind on the shared db object
+        db.metadatas.pop('replica')
+
+    def test_reads_go_to_replica_and_writes_to_primary(self):
+        self.assertEqual(User.query.get(1).name, 'Primary')
+        with replica():
+            self.assertEqual(db.session.execute(select(User.name)).scalar(), 'Replica')
+        db.session.remove()
+
+        self.assertEqual(self.client.get('/v1/auth/profile', headers=self.headers).json['name'], 'Replica')
+        self.client.post('/v1/auth/profile', headers=self.headers, json={'name': 'Updated'})
+        self.assertEqual(User.query.get(1).name, 'Updated')
+        # the write-through keeps the stale replica row out of the cache
+        self.assertEqual(self.client.get('/v1/auth/profile', headers=self.headers).json['name'], 'Updated')
+
+    def test_pool_checkout_is_timed(self):
+        engine = create_engine('sqlite://', **{**engine_options(), 'connect_args': {}})
+        samples = lambda: REGISTRY.get_sample_value('db_pool_checkout_seconds_count', {'bind': 'primary'}) or 0
+        before = samples()
+        with engine.connect():
+            self.assertEqual(engine.pool.checkedout(), 1)
+        self.assertEqual(samples(), before + 1)
+        engine.dispose()
+
+
+class TestMigrations(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_sqlite_app()
+        self.app.cli.add_command(migrate_command)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+
+    def test_migrates_in_order_once(self):
+        self.assertEqual([version for version, _ in migrate(db.engine, target=3)], [1, 2, 3])
+        # a database created before the indexes were declared
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql('DROP INDEX ix_events_user_id_start_date')
+            connection.exec_driver_sql('DROP INDEX ix_events_previous_event_id')
+
+        self.assertEqual([version for version, _ in migrate(db.engine)], [4, 5, 6, 7, 8])
+        self.assertEqual({index['name']: index['column_names'] for index in sa_inspect(db.engine).get_indexes('events')},
+                         {'ix_events_user_id_start_date': ['user_id', 'start_date'],
+                          'ix_events_previous_event_id': ['previous_event_id']})
+        self.assertEqual(migrate(db.engine), [])
+
+    def test_cli(self):
+        runner = self.app.test_cli_runner()
+        self.assertIn('pending    1', runner.invoke(args=['migrate', '--status']).output)
+        result = runner.invoke(args=['migrate'])
+        self.assertEqual(result.output.count('applied'), len(MIGRATIONS))
+        self.assertIn('up to date', runner.invoke(args=['migrate']).output)
+
+
+class TestRequestMetrics(unittest.TestCase):
+
+    def path_labels(self):
+        return {sample.labels['path'] for metric in REGISTRY.collect() if metric.name == 'by_path_counter'
+                for sample in metric.samples}
+
+    def test_labels_stay_bounded_under_path_fuzzing(self):
+        client = app.test_client()
+        client.get('/v1/mock/test')
+        for _ in range(300):
+            path = '/' + '/'.join(''.join(random.choices(string.ascii_letters + '%.-', k=8)) for _ in range(3))
+            client.open(path, method=random.choice(['GET', 'POST', 'PROPFIND', 'X' + str(random.random())]))
+            client.get(f'/v1/auth/user?id={random.random()}')
+
+        rules = {rule.rule for rule in app.url_map.iter_rules()}
+        self.assertIn('/v1/mock/test', self.path_labels())
+        self.assertLessEqual(self.path_labels(), rules | {'<unmatched>'})
+        methods = {sample.labels['method'] for metric in REGISTRY.collect() if metric.name == 'by_path_counter'
+                   for sample in metric.samples}
+        self.assertLessEqual(methods, {'GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'HEAD', 'OPTIONS', '<other>'})
+
+    def test_multiprocess_aggregation(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for _ in range(2):
+                subprocess.run([sys.executable, '-c', 'from prometheus_client import Counter; '
+                                                      'Counter("worker_requests", "test").inc(2)'],
+                               env={**os.environ, 'PROMETHEUS_MULTIPROC_DIR': directory}, check=True)
+            with mock.patch('services.metrics.PROMETHEUS_MULTIPROC_DIR', directory):
+                response = app.test_client().get('/v1/metrics/')
+        self.assertIn('worker_requests_total 4.0', response.get_data(as_text=True))
+
+
+class TestAppFactory(unittest.TestCase):
+
+    def test_apps_are_independent(self):
+        other = create_app()
+        self.assertIsNot(other, app)
+        self.assertEqual({rule.rule for rule in other.url_map.iter_rules()},
+                         {rule.rule for rule in app.url_map.iter_rules()})
+        self.assertEqual(other.test_client().get('/v1/health/ready').status_code, 200)
+        self.assertIn('migrate', other.cli.commands)
+
+
+class TestRateLimit(unittest.TestCase):
+
+    def test_sliding_window(self):
+        state, retry_after = slide(None, 2, 10, 0)
+        state, retry_after = slide(state, 2, 10, 1)
+        self.assertEqual(retry_after, 0)
+        state, retry_after = slide(state, 2, 10, 2)
+        self.assertAlmostEqual(retry_after, 8)
+        # the previous window still counts fully at its end and half way through the next one
+        self.assertGreater(slide(state, 2, 10, 10)[1], 0)
+        state, retry_after = slide(state, 2, 10, 15)
+        self.assertEqual(retry_after, 0)
+        self.assertEqual(state, (10, 2, 1))
+        self.assertEqual(slide(state, 2, 10, 35)[0], (30, 0, 1))
+
+    def test_memory_backend_evicts_stale_keys(self):
+        backend = MemoryBackend(max_keys=2)
+        for key in ('a', 'b', 'c'):
+            backend.hit(key, 5, 10, 0)
+        self.assertEqual(list(backend.states), ['b', 'c'])
+
+    def test_sqlite_backend_is_shared(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'ratelimit.db')
+            first, second = SqliteBackend(path), SqliteBackend(path)
+            self.assertEqual(first.hit('login_ip:1.2.3.4', 2, 60, 0), 0)
+            self.assertEqual(second.hit('login_ip:1.2.3.4', 2, 60, 1), 0)
+            self.assertGreater(first.hit('login_ip:1.2.3.4', 2, 60, 2), 0)
+            first.close()
+            second.close()
+
+    def test_client_ip_behind_proxy_and_malformed_login(self):
+        client = create_app().test_client()
+        with mock.patch.object(login_ip_limiter, 'hit', return_value=0) as hit:
+            for body in (['user@test.com'], 'user@test.com', {'gmail': 'user@test.com', 'password': 123}):
+                response = client.post('/v1/auth/login', json=body, headers={'X-Forwarded-For': '203.0.113.7'},
+                                       environ_base={'REMOTE_ADDR': '10.0.0.2'})
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual({call.args for call in hit.call_args_list}, {('203.0.113.7',)})
+
+    def test_login_rejected_before_db_and_bcrypt(self):
+        sqlite_app = create_sqlite_app()
+        sqlite_app.register_blueprint(auth_bp)
+        client = sqlite_app.test_client()
+        with sqlite_app.app_context(), \
+                mock.patch.multiple(login_account_limiter, limit=2, backend=MemoryBackend()), \
+                mock.patch.object(login_ip_limiter, 'backend', MemoryBackend()), \
+                mock.patch('services.auth.check_password', return_value=False) as check:
+            db.create_all()
+            db.session.add(User(name='User', gmail='user@test.com', password='hash'))
+            db.session.commit()
+            for _ in range(2):
+                response = client.post('/v1/auth/login', json={'gmail': 'user@test.com', 'password': 'guess'})
+                self.assertEqual(response.status_code, 401)
+
+            statements = []
+            listener = lambda *args: statements.append(args[2])
+            sa_event.listen(db.engine, 'before_cursor_execute', listener)
+            try:
+                response = client.post('/v1/auth/login', json={'gmail': ' USER@test.com', 'password': 'guess'})
+            finally:
+                sa_event.remove(db.engine, 'before_cursor_execute', listener)
+            self.assertEqual(response.status_code, 429)
+            self.assertGreater(int(response.headers['Retry-After']), 0)
+            self.assertEqual(statements, [])
+            self.assertEqual(check.call_count, 2)
+
+            response = client.post('/v1/auth/login', json={'gmail': 'other@test.com', 'password': 'guess'})
+            self.assertEqual(response.status_code, 401)
+            db.session.remove()
+            db.drop_all()
+
+
+class TestBulkhead(unittest.TestCase):
+
+    def setUp(self):
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        slow_bp = Blueprint('slow', __name__, url_prefix='/slow')
+
+        @slow_bp.route('/wait')
+        def wait():
+            self.entered.set()
+            self.release.wait(5)
+            return jsonify({'remaining': remaining()})
+
+        @slow_bp.route('/sleep')
+        def sleep():
+            time.sleep(bounded_timeout(1))
+            check_deadline()
+            return jsonify({})
+
+        self.app = Flask(__name__)
+        self.app.register_blueprint(slow_bp)
+        self.app.register_blueprint(health_bp)
+        init_bulkheads(self.app, default_limit=1, limits={}, exempt={'health'},
+                       default_deadline=10, deadlines={'slow.sleep': 0.05})
+
+    def test_full_bulkhead_sheds_and_health_stays_open(self):
+        client = self.app.test_client()
+        responses = []
+        thread = threading.Thread(target=lambda: responses.append(client.get('/slow/wait')))
+        thread.start()
+        try:
+            self.assertTrue(self.entered.wait(5))
+            response = client.get('/slow/sleep')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+            self.assertEqual(client.get('/v1/health/ready').status_code, 200)
+        finally:
+            self.release.set()
+            thread.join(5)
+        self.assertEqual(responses[0].status_code, 200)
+        self.assertTrue(0 < responses[0].json['remaining'] <= 10)
+        self.assertEqual(REGISTRY.get_sample_value('bulkhead_inflight', {'bulkhead': 'slow'}), 0)
+        self.assertEqual(REGISTRY.get_sample_value('bulkhead_capacity', {'bulkhead': 'slow'}), 1)
+
+    def test_deadline_exceeded(self):
+        started = time.monotonic()
+        response = self.app.test_client().get('/slow/sleep')
+        self.assertEqual(response.status_code, 504)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertIsNone(remaining())
+        self.assertEqual(bounded_timeout(3), 3)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_transitions(self):
+        state = after_call(None, False, 2, 0)
+        self.assertEqual(state, (CLOSED, 1, 0, 0))
+        state = after_call(after_call(state, True, 2, 1), False, 2, 2)
+        self.assertEqual(state[:2], (CLOSED, 1))
+        state = after_call(state, False, 2, 3)
+        self.assertEqual(state, (OPEN, 2, 3, 0))
+        self.assertFalse(before_call(state, 10, 2, 12)[1])
+
+        # two probes at once, the third call waits for their outcome
+        state, allowed = before_call(state, 10, 2, 13)
+        self.assertEqual((state, allowed), ((HALF_OPEN, 2, 13, 1), True))
+        state, allowed = before_call(state, 10, 2, 14)
+        self.assertTrue(allowed)
+        self.assertFalse(before_call(state, 10, 2, 15)[1])
+        # probes that never reported back are given up
+        self.assertEqual(before_call(state, 10, 2, 23), ((HALF_OPEN, 2, 23, 1), True))
+
+        self.assertEqual(after_call(state, False, 2, 16), (OPEN, 3, 16, 0))
+        self.assertEqual(after_call(state, True, 2, 16), (CLOSED, 0, 16, 0))
+
+    def test_fresh_breaker_is_closed(self):
+        breaker = CircuitBreaker('fresh_test', backend=circuit_module.MemoryBackend())
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertEqual(breaker.backend.states, {})
+        with tempfile.TemporaryDirectory() as directory:
+            breaker = CircuitBreaker('fresh_test', backend=circuit_module.SqliteBackend(os.path.join(directory, 'c.db')))
+            self.assertEqual(breaker.state, CLOSED)
+            breaker.backend.close()
+
+    def test_state_shared_through_sqlite_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'circuits.db')
+            # one breaker per worker process, both pointing at the same file
+            first = CircuitBreaker('shared_test', failure_threshold=2, recovery_timeout=60,
+                                   backend=circuit_module.SqliteBackend(path))
+            second = CircuitBreaker('shared_test', failure_threshold=2, recovery_timeout=60,
+                                    backend=circuit_module.SqliteBackend(path))
+            self.assertTrue(first.allow())
+            first.record(False)
+            self.assertTrue(second.allow())
+            second.record(False)
+            self.assertFalse(first.allow())
+            self.assertEqual(first.state, OPEN)
+            self.assertEqual(REGISTRY.get_sample_value('circuit_breaker_state',
+                                                       {'breaker': 'shared_test', 'state': OPEN}), 1)
+            self.assertEqual(REGISTRY.get_sample_value('circuit_breaker_transitions_total', {
+                'breaker': 'shared_test', 'from_state': CLOSED, 'to_state': OPEN}), 1)
+            first.backend.close()
+            second.backend.close()
+
+    def test_decorator_fallback_and_probe(self):
+        calls = []
+
+        @circuit('decorator_test', failure_threshold=1, recovery_timeout=60, expected_exception=ValueError,
+                 fallback_function=lambda: 'fallback', backend=circuit_module.MemoryBackend())
+        def view(user_id):
+            calls.append(user_id)
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            view(user_id=1)
+        # the fallback is called without the view arguments
+        self.assertEqual(view(user_id=2), 'fallback')
+        self.assertEqual(calls, [1])
+
+        with mock.patch('core.circuit.time.time', return_value=time.time() + 61):
+            self.assertTrue(view.breaker.allow())
+            self.assertFalse(view.breaker.allow())
+            view.breaker.record(True)
+        self.assertEqual(view.breaker.state, CLOSED)
+
+        # unexpected exceptions neither count as failures nor reset them
+        unexpected = circuit('unexpected_test', failure_threshold=2, expected_exception=ValueError,
+                             backend=circuit_module.MemoryBackend())(mock.Mock(side_effect=[ValueError(), KeyError()]))
+        for exception in (ValueError, KeyError):
+            with self.assertRaises(exception):
+                unexpected()
+        self.assertEqual(unexpected.breaker.backend.states['unexpected_test'][:2], (CLOSED, 1))
+
+        breaker = circuit('no_fallback_test', failure_threshold=1, backend=circuit_module.MemoryBackend())
+        failing = breaker(mock.Mock(side_effect=Exception()))
+        with self.assertRaises(Exception):
+            failing()
+        with self.assertRaises(CircuitOpen):
+            failing()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,69 @@
+import hashlib
+import jwt
+import time
+import uuid
+from datetime import datetime, timedelta
+from flask import g, jsonify, request
+from functools import wraps
+from core.cache import TTLCache
+from core.config import *
+from core.revocation import revocation_list
+
+# sha256 of the raw token -> verified claims, entries never outlive the token's exp
+token_cache = TTLCache('verified_tokens', TOKEN_CACHE_TTL, maxsize=TOKEN_CACHE_SIZE)
+
+
+def generate_token(user_id, is_admin, expiration_minutes=60 * 8):
+    payload = {
+        'user_id': user_id,
+        'is_admin': is_admin,
+        'jti': uuid.uuid4().hex,
+        'iat': time.time(),
+        'exp': datetime.utcnow() + timedelta(minutes=expiration_minutes)
+    }
+
+    token = jwt.encode(payload, JWT_SECRET, algorithm='HS256')
+    return token
+
+
+def decode_token(jwt_token):
+    """Verified claims of the token, only a successfully verified token is ever cached."""
+    key = hashlib.sha256(jwt_token.encode('utf-8')).digest()
+    payload = token_cache.get(key)
+    if payload is not None:
+        if payload['exp'] > time.time():
+            return payload
+        token_cache.invalidate(key)
+
+    payload = jwt.decode(jwt_token, JWT_SECRET, algorithms=['HS256'], options={'require': ['exp']})
+    token_cache.set(key, payload, ttl=min(payload['exp'] - time.time(), TOKEN_CACHE_TTL))
+    return payload
+
+
+def validate_token(admin_req=False):
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            token = request.headers.get('Authorization')
+            if not token:
+                return jsonify({'message': 'Token is missing'}), 401
+
+            try:
+                payload = decode_token(token[7:])
+            except jwt.ExpiredSignatureError:
+                return jsonify({'message': 'Token has expired'}), 401
+            except jwt.InvalidTokenError:
+                return jsonify({'message': 'Invalid token'}), 401
+
+            if revocation_list.is_revoked(payload):
+                return jsonify({'message': 'Token has been revoked'}), 401
+
+            g.token_claims = payload
+            if admin_req and not payload.get('is_admin'):
+                return jsonify({'message': 'Admin required for this action'}), 403
+
+            return f(payload.get('user_id'), *args, **kwargs)
+
+        return wrapper
+
+    return decorator
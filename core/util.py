@@ -1,28 +1,41 @@
 from prometheus_client import Counter, Histogram, Summary
 from flask import request, jsonify
+from core.config import *
 from core.logger import logger
-from datetime import datetime
+from datetime import datetime, timezone
+import math
+import os
+import secrets
 import time
-import requests
-import random
 
-by_path_counter = Counter('by_path_counter', 'Request count by request paths', ['path'])
+by_path_counter = Counter('by_path_counter', 'Request count by route template and method', ['path', 'method'])
 response_code_counter = Counter('response_code_counter', 'Count of HTTP response codes', ['status_code'])
-request_duration_histogram = Histogram('request_duration_seconds', 'Request duration in seconds', ['path'])
+request_duration_histogram = Histogram('request_duration_seconds', 'Request duration in seconds by route template',
+                                       ['path', 'method'])
 request_size_summary = Summary('request_size_bytes', 'Request size in bytes')
 
+# loaded once, every registration draws from the in-memory tuple
+with open(os.path.join(os.path.dirname(__file__), 'data', 'animals.txt')) as words_file:
+    PASSWORD_WORDS = tuple(word.strip() for word in words_file if word.strip())
+
+
+# label values are limited to the registered routes and these methods, so scanners can't add series
+METRIC_METHODS = {'GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'HEAD', 'OPTIONS'}
+
 
 def before_request():
-    if '/metrics' not in request.path:
-        request.start_time = time.time()
+    if request.blueprint != 'metrics':
+        request.start_time = time.perf_counter()
 
 
 def after_request(response):
-    if '/metrics' not in request.path:
-        by_path_counter.labels(request.path).inc()
+    if request.blueprint != 'metrics' and hasattr(request, 'start_time'):
+        path = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+        method = request.method if request.method in METRIC_METHODS else '<other>'
+        by_path_counter.labels(path, method).inc()
         response_code_counter.labels(str(response.status_code)).inc()
-        duration = time.time() - request.start_time
-        request_duration_histogram.labels(request.path).observe(duration)
+        duration = time.perf_counter() - request.start_time
+        request_duration_histogram.labels(path, method).observe(duration)
         if 'Content-Length' in request.headers:
             request_size_summary.observe(int(request.headers['Content-Length']))
 
@@ -39,16 +52,11 @@ def handle_service_unavailable():
     return jsonify({'error': 'Service currently not available'}), 503
 
 
-def generate_random_pass():
-    url = 'https://gist.githubusercontent.com/borlaym/585e2e09dd6abd9b0d0a/raw/6e46db8f5c27cb18fd1dfa50c7c921a0fbacbad0/animals.json'
-    response = requests.get(url)
-    if response.status_code == 200:
-        data = response.json()
-        selected_strings = random.sample(data, 3)
-        joined_string = ''.join(selected_strings).replace(" ", "")
-        return joined_string
-    else:
-        return "super_safe_password_placeholder"
+def generate_random_pass(word_count=None, min_entropy_bits=None):
+    word_count = word_count or PASSWORD_WORD_COUNT
+    min_entropy_bits = PASSWORD_MIN_ENTROPY_BITS if min_entropy_bits is None else min_entropy_bits
+    word_count = max(word_count, math.ceil(min_entropy_bits / math.log2(len(PASSWORD_WORDS))))
+    return ''.join(secrets.choice(PASSWORD_WORDS) for _ in range(word_count))
 
 
 def get_first_day_of_month():
@@ -56,3 +64,26 @@ def get_first_day_of_month():
     return current_date.replace(year=2020, day=1, hour=0,
                                 minute=0, second=0, microsecond=0)
 
+
+def parse_bool(value):
+    """Flag from a query argument, form or JSON value."""
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes')
+    return bool(value)
+
+
+def parse_utc_datetime(value):
+    """ISO date or datetime as naive UTC, the way event times are stored."""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def parse_date_range(args):
+    """Reads the from/to query arguments (ISO dates), from defaults to the first day of the month."""
+    since = parse_utc_datetime(args['from']) if args.get('from') else get_first_day_of_month()
+    until = parse_utc_datetime(args['to']) if args.get('to') else None
+    if until is not None and until <= since:
+        raise ValueError('to must be after from')
+    return since, until
@@ -0,0 +1,63 @@
+"""
+gunicorn settings, tuned through environment variables:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+import os
+import shutil
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', (os.cpu_count() or 1) * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+# gevent needs the gevent package installed in the image
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread' if threads > 1 else 'sync')
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+# recycle workers to cap slow leaks, the jitter keeps them from restarting together
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 5000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 500))
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG') or None
+
+# the app starts threads and process pools, those don't survive a fork so every worker imports it itself
+preload_app = False
+
+# workers share their prometheus metrics through this directory, set before any worker imports the client
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/workclock-metrics')
+# and their rate limit counters, circuit breaker state and report jobs through these sqlite files
+SHARED_STORES = {
+    'RATE_LIMIT_STORE': '/tmp/workclock-ratelimits.db',
+    'CIRCUIT_BREAKER_STORE': '/tmp/workclock-circuits.db',
+    'REPORT_JOB_STORE': '/tmp/workclock-jobs.db',
+}
+for name, path in SHARED_STORES.items():
+    os.environ.setdefault(name, path)
+
+# imported here, child_exit runs in the master's signal handler where a first import can deadlock or fail
+from prometheus_client import multiprocess  # noqa: E402
+
+
+def on_starting(server):
+    directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    for name in SHARED_STORES:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(os.environ[name] + suffix):
+                os.remove(os.environ[name] + suffix)
+
+
+def post_worker_init(worker):
+    # deliver what previous workers left in the outbox without waiting for the next registration
+    from core.mailer import mail_sender
+    mail_sender.start()
+
+
+def worker_exit(server, worker):
+    from app import shutdown
+    shutdown()
+
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,20 +1,77 @@
-from flask import Blueprint, request, jsonify
-from flasgger import swag_from
+from flask import Blueprint, Response, g, request, jsonify, stream_with_context
+from core.docs import swag_from
+from io import StringIO
+import csv
+import json
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
-from core.models import db, User, bcrypt
-from core.token import generate_token, validate_token
-from core.mailer import send_email
-from circuitbreaker import circuit
+from core.models import db, User
+from core.hashing import hash_password, hash_passwords, check_password
+from datetime import datetime
+from hashlib import sha256
+from core.config import *
+from core.queries import USER_FIELDS, insert_users_skip_conflicts, invalidate_profile, record_profile_change, \
+    store_profile, user_profile, user_rows
+from core.ratelimit import RateLimiter, client_ip, rate_limit
+from core.database import iter_on_replica, read_only, replica
+from core.revocation import revocation_list, revoke_token, revoke_user_tokens
+from core.tokens import generate_token, validate_token
+from core.mailer import send_email, mail_sender
+from core.circuit import circuit
 from core.logger import logger
-from core.util import generate_random_pass, handle_service_unavailable
+from core.util import generate_random_pass, handle_service_unavailable, parse_bool
 
 auth_bp = Blueprint('auth', __name__, url_prefix="/v1/auth")
 
+login_ip_limiter = RateLimiter('login_ip', LOGIN_RATE_LIMIT_PER_IP, LOGIN_RATE_LIMIT_WINDOW)
+login_account_limiter = RateLimiter('login_account', LOGIN_RATE_LIMIT_PER_ACCOUNT, LOGIN_RATE_LIMIT_WINDOW)
+
+
+def queue_welcome_email(gmail, password):
+    send_email(
+        gmail,
+        'Welcome to WorkClock',
+        f'Hi {gmail},\n\nWelcome to WorkClock!\nYour password is {password}\n\nRegards,\nWorkClock team',
+        commit=False
+    )
+
+
+def login_gmail():
+    data = request.get_json(silent=True)
+    gmail = data.get('gmail') if isinstance(data, dict) else None
+    return gmail.strip().lower() if isinstance(gmail, str) and gmail.strip() else None
+
+
+def profile_response(user_id):
+    profile = user_profile(user_id)
+    if profile is None:
+        return jsonify({'message': 'User not found'}), 404
+
+    etag = sha256(json.dumps(profile, sort_keys=True).encode()).hexdigest()
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = jsonify(profile)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def read_bulk_users():
+    if 'file' in request.files:
+        return list(csv.DictReader(StringIO(request.files['file'].read().decode('utf-8-sig'))))
+    if request.mimetype == 'text/csv':
+        return list(csv.DictReader(StringIO(request.get_data(as_text=True))))
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, list) or not all(isinstance(item, dict) for item in data):
+        raise ValueError('Expected a JSON array of users or a CSV upload')
+    return data
+
 
 @auth_bp.route('/register', methods=['POST'])
 @validate_token(admin_req=True)
-@circuit(failure_threshold=2, expected_exception=Exception,
+@circuit('register', failure_threshold=2, expected_exception=Exception,
          recovery_timeout=60, fallback_function=handle_service_unavailable)
 @swag_from({
     'summary': 'Endpoint for user registration.',
@@ -38,18 +95,15 @@ def register(user_id):
     if any(field is None for field in [name, gmail, is_admin, user_id]):
         return jsonify({'message': f'Name, Gmail are required'}), 400
 
-    hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
+    hashed_password = hash_password(password)
     new_user = User(name=name, gmail=gmail, is_admin=is_admin,
                     created_by=user_id, password=hashed_password)
 
     try:
         db.session.add(new_user)
+        queue_welcome_email(gmail, password)
         db.session.commit()
-        send_email(
-            gmail,
-            'Welcome to WorkClock',
-            f'Hi {gmail},\n\nWelcome to WorkClock!\nYour password is {password}\n\nRegards,\nWorkClock team'
-        )
+        mail_sender.wake()
         logger.info(f'User {gmail} was registered successfully - pass: {password}')
         return jsonify({'message': 'User registered successfully'}), 201
     except IntegrityError:
@@ -57,7 +111,76 @@ def register(user_id):
         return jsonify({'message': 'gmail already exists'}), 400
 
 
+@auth_bp.route('/register/bulk', methods=['POST'])
+@validate_token(admin_req=True)
+@swag_from({
+    'summary': 'Endpoint for registering many users at once.',
+    'description': 'Accepts a JSON array of users or a CSV upload (columns name, gmail, is_admin) '
+                   'and reports the outcome of every row.',
+    'responses': {
+        200: {
+            'description': 'Per-row results: created, conflict (gmail exists), duplicate (repeated in request) '
+                           'or invalid.'
+        },
+        400: {
+            'description': 'Body is neither a JSON array nor CSV, or has too many rows.'
+        }
+    }
+})
+def register_bulk(user_id):
+    try:
+        rows = read_bulk_users()
+    except (ValueError, UnicodeDecodeError, csv.Error) as ex:
+        return jsonify({'message': str(ex)}), 400
+    if len(rows) > AUTH_BULK_MAX_ROWS:
+        return jsonify({'message': f'At most {AUTH_BULK_MAX_ROWS} users can be registered at once'}), 400
+
+    results = []
+    accepted = {}
+    for index, row in enumerate(rows):
+        name, gmail, is_admin = row.get('name') or '', row.get('gmail') or '', row.get('is_admin', False)
+        result = {'row': index, 'gmail': gmail.strip() if isinstance(gmail, str) else gmail}
+        results.append(result)
+        if not isinstance(name, str) or not isinstance(gmail, str):
+            result.update(status='invalid', message='Name, Gmail must be strings')
+            continue
+        if not isinstance(is_admin, (bool, int, str)) and is_admin is not None:
+            result.update(status='invalid', message='is_admin must be a boolean')
+            continue
+        name, gmail = name.strip(), gmail.strip()
+        if not name or not gmail:
+            result.update(status='invalid', message='Name, Gmail are required')
+        elif gmail in accepted:
+            result.update(status='duplicate', message=f'Same gmail as row {accepted[gmail]["row"]}')
+        else:
+            accepted[gmail] = {'row': index, 'name': name, 'is_admin': parse_bool(is_admin)}
+
+    if accepted:
+        passwords = [generate_random_pass() for _ in accepted]
+        hashed_passwords = hash_passwords(passwords)
+        inserted = insert_users_skip_conflicts([
+            {'name': user['name'], 'gmail': gmail, 'is_admin': user['is_admin'],
+             'created_by': user_id, 'password': hashed_password}
+            for (gmail, user), hashed_password in zip(accepted.items(), hashed_passwords)
+        ])
+        for (gmail, user), password in zip(accepted.items(), passwords):
+            result = results[user['row']]
+            if gmail in inserted:
+                result.update(status='created', id=inserted[gmail])
+                queue_welcome_email(gmail, password)
+            else:
+                result.update(status='conflict', message='gmail already exists')
+        db.session.commit()
+        mail_sender.wake()
+
+    summary = {status: sum(1 for result in results if result['status'] == status)
+               for status in ('created', 'conflict', 'duplicate', 'invalid')}
+    logger.info(f'Bulk registration by {user_id}: {summary}')
+    return jsonify({'summary': summary, 'results': results}), 200
+
+
 @auth_bp.route('/login', methods=['POST'])
+@rate_limit((login_ip_limiter, client_ip), (login_account_limiter, login_gmail))
 @swag_from({
     'summary': 'Endpoint for user login.',
     'description': 'Authenticate a user with Gmail and password.',
@@ -78,20 +201,25 @@ def register(user_id):
         },
         401: {
             'description': 'Invalid credentials or user not found.'
+        },
+        429: {
+            'description': 'Too many attempts from this address or for this account, see Retry-After.'
         }
     }
 })
 def login():
-    data = request.get_json()
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'message': 'Expected a JSON object'}), 400
     gmail = data.get('gmail')
     password = data.get('password')
 
-    if not gmail or not password:
+    if not isinstance(gmail, str) or not isinstance(password, str) or not gmail or not password:
         return jsonify({'message': 'gmail and password are required'}), 400
 
     try:
         user = User.query.filter_by(gmail=gmail).first()
-        if user and bcrypt.check_password_hash(user.password, password):
+        if user and check_password(user.password, password):
             token = generate_token(user.id, user.is_admin)
             logger.info(f'User login success {gmail}')
             return jsonify({'message': 'Login successful', 'token': token, 'is_admin': user.is_admin})
@@ -102,6 +230,31 @@ def login():
         return jsonify({'message': 'User not found'}), 401
 
 
+@auth_bp.route('/logout', methods=['POST'])
+@validate_token()
+@swag_from({
+    'summary': 'Endpoint for user logout.',
+    'description': 'Revoke the token used for this request.',
+    'responses': {
+        200: {
+            'description': 'Token revoked.'
+        },
+        401: {
+            'description': 'Token is missing, invalid or already revoked.'
+        }
+    }
+})
+def logout(user_id):
+    claims = g.token_claims
+    if not claims.get('jti'):
+        # tokens issued before revocation support can only be revoked together with all of the user's tokens
+        revoke_user_tokens(user_id)
+    else:
+        revoke_token(claims['jti'], datetime.utcfromtimestamp(claims['exp']))
+    logger.info(f'User {user_id} logged out')
+    return jsonify({'message': 'Logout successful'}), 200
+
+
 @auth_bp.route('/profile', methods=['GET', 'POST'])
 @validate_token()
 @swag_from({
@@ -129,23 +282,32 @@ def login():
     }
 })
 def profile(user_id):
+    if request.method == 'GET':
+        with replica():
+            return profile_response(user_id)
+
     user = User.query.filter_by(id=user_id).first()
     if not user:
         return jsonify({'message': 'User not found'}), 404
 
-    if request.method == 'GET':
-        return jsonify({'id': user.id, 'gmail': user.gmail, 'name': user.name, 'is_admin': user.is_admin}), 200
-
     data = request.get_json()
     user.name = data.get('name', user.name)
     user.gmail = data.get('gmail', user.gmail)
-    hashed_password = bcrypt.generate_password_hash(data['password']).decode('utf-8') if data.get('password') else user.password
+    hashed_password = hash_password(data['password']) if data.get('password') else user.password
     user.password = hashed_password
+    if data.get('password'):
+        revoke_user_tokens(user.id, commit=False)
+    record_profile_change(user.id)
     logger.info(f'User {user.id} was updated with data name: {user.name}, gmail: {user.gmail}')
 
     try:
         db.session.commit()
-        return jsonify({'message': 'User update success'}), 200
+        store_profile(user)
+        if not data.get('password'):
+            return jsonify({'message': 'User update success'}), 200
+        # every older token of the user is revoked now, including the one of this request
+        revocation_list.sync()
+        return jsonify({'message': 'User update success', 'token': generate_token(user.id, user.is_admin)}), 200
     except Exception as ex:
         logger.error(str(ex))
         db.session.rollback()
@@ -156,18 +318,90 @@ def profile(user_id):
 @validate_token(admin_req=True)
 @swag_from({
     'summary': 'Endpoint to fetch all users.',
-    'description': 'Retrieve details of all registered users.',
+    'description': 'Retrieve registered users ordered by id, one page at a time or streamed as NDJSON.',
+    'parameters': [
+        {
+            'name': 'limit',
+            'in': 'query',
+            'type': 'integer',
+            'required': False,
+            'description': f'Page size, at most {AUTH_USERS_MAX_PAGE_SIZE}. Without limit and after_id every user '
+                           f'is returned, with only after_id the page holds {AUTH_USERS_PAGE_SIZE}'
+        },
+        {
+            'name': 'after_id',
+            'in': 'query',
+            'type': 'integer',
+            'required': False,
+            'description': 'Cursor, return users with a greater id (next_cursor of the previous page)'
+        },
+        {
+            'name': 'fields',
+            'in': 'query',
+            'type': 'string',
+            'required': False,
+            'description': f'Comma separated subset of {", ".join(USER_FIELDS)}, id is always included'
+        },
+        {
+            'name': 'stream',
+            'in': 'query',
+            'type': 'boolean',
+            'required': False,
+            'description': 'Stream every user after the cursor as NDJSON instead of returning a page'
+        }
+    ],
     'responses': {
         200: {
-            'description': 'All users retrieved successfully.'
+            'description': 'Users and next_cursor, which is null on the last page.'
+        },
+        400: {
+            'description': 'Invalid limit, cursor or fields.'
         }
     }
 })
+@read_only
 def get_all(_):
-    users = User.query.all()
-    logger.info(f'All users were fetched count: {len(users)}')
-    return jsonify({'users': [{'id': u.id, 'name': u.name, 'gmail': u.gmail,
-                               'is_admin': u.is_admin, 'created_by': u.created_by} for u in users]}), 200
+    paged = 'limit' in request.args or 'after_id' in request.args
+    limit = request.args.get('limit', type=int) if 'limit' in request.args else AUTH_USERS_PAGE_SIZE
+    after_id = request.args.get('after_id', type=int)
+    if 'after_id' in request.args and after_id is None:
+        return jsonify({'message': 'after_id must be an integer'}), 400
+    if limit is None or not 0 < limit <= AUTH_USERS_MAX_PAGE_SIZE:
+        return jsonify({'message': f'limit must be between 1 and {AUTH_USERS_MAX_PAGE_SIZE}'}), 400
+
+    fields = ['id']
+    for field in request.args.get('fields', ','.join(USER_FIELDS)).split(','):
+        if field not in USER_FIELDS:
+            return jsonify({'message': f'fields must be a subset of {", ".join(USER_FIELDS)}'}), 400
+        if field not in fields:
+            fields.append(field)
+
+    if parse_bool(request.args.get('stream', '')):
+        def generate():
+            for row in user_rows(fields, after_id):
+                yield json.dumps(dict(zip(fields, row))) + '\n'
+
+        return Response(stream_with_context(iter_on_replica(generate())), mimetype='application/x-ndjson')
+
+    if not paged:
+        # callers from before the pagination expect the whole list, written out as it is read
+        def generate():
+            count = 0
+            yield '{"users": ['
+            for row in user_rows(fields):
+                yield (',' if count else '') + json.dumps(dict(zip(fields, row)))
+                count += 1
+            yield '], "next_cursor": null}'
+            logger.info(f'All users were fetched count: {count}')
+
+        return Response(stream_with_context(iter_on_replica(generate())), mimetype='application/json')
+
+    # one extra row tells whether another page exists without a COUNT
+    rows = user_rows(fields, after_id, limit + 1).all()
+    users = [dict(zip(fields, row)) for row in rows[:limit]]
+    next_cursor = users[-1]['id'] if len(rows) > limit else None
+    logger.info(f'Users page was fetched count: {len(users)}')
+    return jsonify({'users': users, 'next_cursor': next_cursor}), 200
 
 
 @auth_bp.route('/remove-user', methods=['DELETE'])
@@ -194,7 +428,11 @@ def remove_user(_):
     if user_to_delete:
         try:
             db.session.delete(user_to_delete)
+            revoke_user_tokens(user_to_delete.id, commit=False)
+            record_profile_change(user_to_delete.id)
             db.session.commit()
+            invalidate_profile(user_to_delete.id)
+            revocation_list.sync()
             return jsonify({'message': 'User deleted successfully'}), 200
         except Exception as e:
             logger.error(str(e))
@@ -232,28 +470,34 @@ def remove_user(_):
     }
 })
 def admin_user_action(_):
-    user_id = request.args.get('id')
+    user_id = request.args.get('id', type=int)
+    if request.method == 'GET':
+        with replica():
+            return profile_response(user_id)
+
     user = User.query.filter_by(id=user_id).first()
     if not user:
         return jsonify({'message': 'User not found'}), 404
 
-    if request.method == 'GET':
-        return jsonify({'id': user.id, 'gmail': user.gmail, 'name': user.name, 'is_admin': user.is_admin}), 200
-    
     req_json = request.get_json()
     data = {
         'name': req_json.get('name', user.name),
         'gmail': req_json.get('gmail', user.gmail),
         'password': req_json.get('password')
     }
-    hashed_password = bcrypt.generate_password_hash(data['password']).decode('utf-8') if data.get('password') else user.password
+    hashed_password = hash_password(data['password']) if data.get('password') else user.password
     user.name = data['name']
     user.gmail = data['gmail']
     user.password = hashed_password
+    if data.get('password'):
+        revoke_user_tokens(user.id, commit=False)
+    record_profile_change(user.id)
     logger.info(f'User {user.id} was updated with data name: {user.name}, gmail: {user.gmail}')
 
     try:
         db.session.commit()
+        store_profile(user)
+        revocation_list.sync()
         return jsonify({'message': 'User update success'}), 200
     except Exception as ex:
         logger.error(str(ex))
@@ -1,5 +1,6 @@
 from flask import Blueprint, jsonify
-from circuitbreaker import circuit
+from core.circuit import circuit
+from core.bulkhead import bounded_timeout, check_deadline
 from core.logger import logger
 from core.util import handle_service_unavailable
 import random
@@ -15,7 +16,8 @@ class UnluckyException(Exception):
 
 @fault_demo_bp.route('/demo', methods=['GET'])
 def get_demo():
-    time.sleep(3)
+    time.sleep(bounded_timeout(3))
+    check_deadline()
     num = random.randint(5, 10)
     logger.info(f'Guessed {num}')
     if num != GOAL_NUM:
@@ -26,10 +28,11 @@ def get_demo():
 
 
 @fault_demo_bp.route('/demo-circuit', methods=['GET'])
-@circuit(failure_threshold=2, expected_exception=UnluckyException,
+@circuit('fault_demo', failure_threshold=2, expected_exception=UnluckyException,
          recovery_timeout=60, fallback_function=handle_service_unavailable)
 def get_demo_with_circuit():
-    time.sleep(3)
+    time.sleep(bounded_timeout(3))
+    check_deadline()
     num = random.randint(5, 10)
     logger.info(f'Guessed {num}')
     if num != 7:
@@ -1,5 +1,5 @@
 from flask import Blueprint, jsonify
-from flasgger import swag_from
+from core.docs import swag_from
 
 health_bp = Blueprint('health', __name__, url_prefix="/v1/health")
 
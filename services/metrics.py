@@ -1,5 +1,6 @@
 from flask import Blueprint, jsonify, Response
-from prometheus_client import generate_latest
+from prometheus_client import CollectorRegistry, CONTENT_TYPE_LATEST, REGISTRY, generate_latest, multiprocess
+from core.config import *
 
 metrics_bp = Blueprint('metrics', __name__, url_prefix="/v1/metrics")
 
@@ -13,6 +14,15 @@ def test():
     return jsonify({'status': 'ok'})
 
 
+def metrics_registry():
+    """With PROMETHEUS_MULTIPROC_DIR set every worker writes its metrics there, collect all of them."""
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=PROMETHEUS_MULTIPROC_DIR)
+    return registry
+
+
 @metrics_bp.route('/')
 def metrics():
-    return Response(generate_latest(), mimetype="text/plain")
+    return Response(generate_latest(metrics_registry()), content_type=CONTENT_TYPE_LATEST)
@@ -1,5 +1,5 @@
 from flask import Blueprint, jsonify
-from core.token import validate_token
+from core.tokens import validate_token
 
 mock_bp = Blueprint('mock', __name__, url_prefix='/v1/mock/')
 
@@ -1,12 +1,219 @@
-from flask import Blueprint, send_file
-from collections import defaultdict
-from core.models import Event, EventType
-from core.token import validate_token
-from core.util import get_first_day_of_month
-from flasgger import swag_from
-import pdfkit
+from flask import Blueprint, Response, current_app, jsonify, request, send_file, stream_with_context, url_for
+from collections import deque
+import csv
+import json
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+from io import BytesIO, RawIOBase
+from itertools import groupby
+from multiprocessing import get_context
+from zipfile import ZipFile, ZIP_STORED
+from core.cache import LRUByteCache
+from core.config import *
+from core.jobs import JobQueue, QueueFull, SqliteJobStore, DONE, FAILED
+from core.queries import monthly_event_rows, hours_by_event_type, event_type_titles, events_fingerprint, \
+    all_users_event_rows, stream_event_rows, EventTypeTitles, UNKNOWN_EVENT_TYPE
+from core.tokens import validate_token
+from core.database import iter_on_replica, read_only, replica
+from core.renderer import get_renderer, render_monthly_events
+from core.logger import logger
+from core.util import get_first_day_of_month, parse_bool, parse_date_range
+from core.docs import swag_from
 
 reports_bp = Blueprint('reports', __name__, url_prefix='/v1/reports/')
+report_jobs = JobQueue('reports', REPORT_JOB_WORKERS, REPORT_JOB_MAX_PENDING, REPORT_JOB_RESULT_TTL,
+                       SqliteJobStore(REPORT_JOB_STORE) if REPORT_JOB_STORE else None)
+rendered_reports = LRUByteCache('rendered_reports', REPORT_CACHE_MAX_BYTES)
+batch_render_pool = None
+
+ASYNC_PARAMETER = {
+    'name': 'async',
+    'in': 'query',
+    'type': 'boolean',
+    'required': False,
+    'description': 'Queue the report and return a job id instead of the PDF'
+}
+
+
+def pdf_response(pdf, download_name):
+    if len(pdf) <= REPORT_STREAM_THRESHOLD:
+        return send_file(BytesIO(pdf), mimetype='application/pdf',
+                         as_attachment=True, download_name=download_name)
+
+    # large months are sent with chunked transfer encoding straight from the buffer
+    def generate():
+        view = memoryview(pdf)
+        for offset in range(0, len(view), REPORT_STREAM_CHUNK_SIZE):
+            yield bytes(view[offset:offset + REPORT_STREAM_CHUNK_SIZE])
+
+    return Response(generate(), mimetype='application/pdf',
+                    headers={'Content-Disposition': f'attachment; filename={download_name}'})
+
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+EXPORT_PARAMETERS = [
+    {
+        'name': 'format',
+        'in': 'query',
+        'type': 'string',
+        'enum': list(EXPORT_FORMATS),
+        'required': False,
+        'description': 'Output format, csv by default'
+    },
+    {
+        'name': 'from',
+        'in': 'query',
+        'type': 'string',
+        'format': 'date-time',
+        'required': False,
+        'description': 'Include events starting at or after this date, first day of the month by default'
+    },
+    {
+        'name': 'to',
+        'in': 'query',
+        'type': 'string',
+        'format': 'date-time',
+        'required': False,
+        'description': 'Include events starting before this date'
+    }
+]
+
+
+class LineWriter:
+    """File-like target for csv.writer returning each written line instead of buffering it."""
+
+    def write(self, line):
+        return line
+
+
+def export_response(kind, columns, records):
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'message': f'format must be one of {", ".join(EXPORT_FORMATS)}'}), 400
+
+    def generate():
+        if export_format == 'csv':
+            writer = csv.writer(LineWriter())
+            yield writer.writerow(columns)
+            for record in records():
+                yield writer.writerow(record)
+        else:
+            for record in records():
+                yield json.dumps(dict(zip(columns, record)), default=str) + '\n'
+
+    return Response(stream_with_context(iter_on_replica(generate())), mimetype=EXPORT_FORMATS[export_format],
+                    headers={'Content-Disposition': f'attachment; filename={kind}.{export_format}'})
+
+
+class ZipStream(RawIOBase):
+    """Write-only sink for ZipFile, drained after every member so the archive can be streamed."""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def get_batch_render_pool():
+    global batch_render_pool
+    if batch_render_pool is None:
+        # spawn keeps the workers free of the parent's threads and open connections
+        batch_render_pool = ProcessPoolExecutor(max_workers=REPORT_BATCH_WORKERS, mp_context=get_context('spawn'))
+    return batch_render_pool
+
+
+def shutdown_report_workers():
+    global batch_render_pool
+    report_jobs.shutdown()
+    if batch_render_pool is not None:
+        batch_render_pool.shutdown()
+        batch_render_pool = None
+
+
+def report_etag(user_id, kind):
+    since = get_first_day_of_month()
+    key = (user_id, kind, since.isoformat(), get_renderer().name,
+           events_fingerprint(user_id, since), tuple(sorted(event_type_titles().items())))
+    return sha256(repr(key).encode()).hexdigest()
+
+
+def render_cached(user_id, kind, etag=None):
+    etag = etag or report_etag(user_id, kind)
+    pdf = rendered_reports.get(etag)
+    if pdf is None:
+        pdf = REPORT_BUILDERS[kind](user_id)
+        rendered_reports.set(etag, pdf)
+    return pdf
+
+
+def report_response(user_id, kind):
+    download_name = f'{kind}.pdf'
+    if not parse_bool(request.args.get('async', '')):
+        etag = report_etag(user_id, kind)
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            response = pdf_response(render_cached(user_id, kind, etag), download_name)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    app = current_app._get_current_object()
+
+    def run():
+        with app.app_context(), replica():
+            return render_cached(user_id, kind)
+
+    try:
+        job = report_jobs.submit(user_id, run, download_name=download_name)
+    except QueueFull as ex:
+        logger.warning(str(ex))
+        return jsonify({'message': 'Too many reports are being generated, try again later'}), 503
+
+    return jsonify({**job.to_dict(), 'status_url': url_for('reports.job_status', job_id=job.id),
+                    'download_url': url_for('reports.job_download', job_id=job.id)}), 202
+
+
+def build_monthly_events(user_id):
+    events = monthly_event_rows(user_id, get_first_day_of_month())
+
+    titles = EventTypeTitles()
+    rows = ((titles.title(event.event_type_id), event.start_date, event.end_date) for event in events)
+    return get_renderer().monthly_events(rows)
+
+
+def build_grouped_monthly_events(user_id):
+    event_type_hours = hours_by_event_type(user_id, get_first_day_of_month())
+
+    event_types_grouped = EventTypeTitles().covering(event_type_hours)
+    data = [(event_type_hours.get(et_id, .0), et_name) for et_id, et_name in event_types_grouped.items()]
+    unknown_hours = sum(hours for et_id, hours in event_type_hours.items() if et_id not in event_types_grouped)
+    if unknown_hours:
+        data.append((unknown_hours, UNKNOWN_EVENT_TYPE))
+    data.sort(key=lambda x: (-x[0], x[1]))
+    return get_renderer().grouped_events(data)
+
+
+REPORT_BUILDERS = {
+    'monthly-events': build_monthly_events,
+    'grouped-monthly-events': build_grouped_monthly_events,
+}
+
 
 @reports_bp.route('/monthly-events', methods=['GET'])
 @validate_token()
@@ -20,9 +227,16 @@ reports_bp = Blueprint('reports', __name__, url_prefix='/v1/reports/')
             'type': 'integer',
             'required': True,
             'description': 'ID of the authenticated user'
-        }
+        },
+        ASYNC_PARAMETER
     ],
     'responses': {
+        202: {
+            'description': 'Report job queued (async mode).'
+        },
+        304: {
+            'description': 'Report did not change since the ETag sent in If-None-Match.'
+        },
         200: {
             'description': 'PDF file with monthly events.',
             'content': {
@@ -35,37 +249,9 @@ reports_bp = Blueprint('reports', __name__, url_prefix='/v1/reports/')
         }
     }
 })
+@read_only
 def monthly_events(user_id):
-    events = Event.query.filter(
-        Event.start_date >= get_first_day_of_month(),
-        Event.user_id == user_id
-    ).all()
-
-    event_types = EventType.query.all()
-    event_types_grouped = {et.id: et.title for et in event_types}
-
-    html = '''
-        <h1>Monthly events</h1>
-        <table style="width: 100%; border-collapse: collapse; border: 1px solid black;">
-        <tr>
-            <th style="border: 1px solid black;">Event type</th>
-            <th style="border: 1px solid black;">Start</th>
-            <th style="border: 1px solid black;">End</th>
-        </tr>'''
-
-    for event in events:
-        html += f'''<tr>
-            <td style="border: 1px solid black;">&nbsp;&nbsp;{event_types_grouped[event.event_type_id]}</td>
-            <td style="border: 1px solid black;">&nbsp;&nbsp;{event.start_date.strftime("%d/%m/%Y %H:%M")}</td>
-            <td style="border: 1px solid black;">&nbsp;&nbsp;{event.end_date.strftime("%d/%m/%Y %H:%M")}</td>
-        </tr>'''
-    html += '</table>'
-    pdf = pdfkit.from_string(html, False)
-    pdf_file_path = 'generated_pdf.pdf'
-    with open(pdf_file_path, 'wb') as f:
-        f.write(pdf)
-
-    return send_file(pdf_file_path, as_attachment=True)
+    return report_response(user_id, 'monthly-events')
 
 
 @reports_bp.route('/grouped-monthly-events', methods=['GET'])
@@ -80,9 +266,16 @@ def monthly_events(user_id):
             'type': 'integer',
             'required': True,
             'description': 'ID of the authenticated user'
-        }
+        },
+        ASYNC_PARAMETER
     ],
     'responses': {
+        202: {
+            'description': 'Report job queued (async mode).'
+        },
+        304: {
+            'description': 'Report did not change since the ETag sent in If-None-Match.'
+        },
         200: {
             'description': 'Grouped monthly events with total work hours PDF.',
             'content': {
@@ -95,32 +288,198 @@ def monthly_events(user_id):
         }
     }
 })
+@read_only
 def grouped_monthly_events(user_id):
-    events = Event.query.filter(
-        Event.start_date >= get_first_day_of_month(),
-        Event.user_id == user_id
-    ).all()
-
-    event_type_hours = defaultdict(int)
-    for event in events:
-        duration = (event.end_date - event.start_date).total_seconds() / 3600
-        event_type_hours[event.event_type_id] = duration
-
-    event_types = EventType.query.all()
-    event_types_grouped = {et.id: et.title for et in event_types}
-    data = [(event_type_hours.get(et_id, .0), et_name) for et_id, et_name in event_types_grouped.items()]
-    data.sort(key=lambda x: (-x[0], x[1]))
-    html = f'''
-    <h1>Grouped monthly events</h1>
-    <table style="width: 100%; border-collapse: collapse; border: 1px solid black;">
-        <tr>{"".join(f'<th style="border: 1px solid black;">{item[1]}</th>' for item in data)}</tr>
-        <tr>{"".join(f'<td style="border: 1px solid black;">&nbsp;&nbsp;{item[0]}</td>' for item in data)}</tr>
-    </table>
-    '''
-    pdf = pdfkit.from_string(html, False)
-    pdf_file_path = 'generated_pdf.pdf'
-    with open(pdf_file_path, 'wb') as f:
-        f.write(pdf)
-
-    return send_file(pdf_file_path, as_attachment=True)
-    
\ No newline at end of file
+    return report_response(user_id, 'grouped-monthly-events')
+
+
+@reports_bp.route('/jobs/<job_id>', methods=['GET'])
+@validate_token()
+@swag_from({
+    'summary': 'Endpoint for polling the status of a queued report.',
+    'description': 'Returns the status of a report job submitted with async=true.',
+    'responses': {
+        200: {
+            'description': 'Job status (queued, running, done or failed).'
+        },
+        404: {
+            'description': 'Job not found or already expired.'
+        }
+    }
+})
+def job_status(user_id, job_id):
+    job = report_jobs.get(job_id, owner=user_id)
+    if not job:
+        return jsonify({'message': 'Job not found'}), 404
+
+    return jsonify({**job.to_dict(), 'download_url': url_for('reports.job_download', job_id=job.id)}), 200
+
+
+@reports_bp.route('/jobs/<job_id>/download', methods=['GET'])
+@validate_token()
+@swag_from({
+    'summary': 'Endpoint for downloading the PDF of a finished report job.',
+    'description': 'Downloads the PDF produced by a report job submitted with async=true.',
+    'responses': {
+        200: {
+            'description': 'PDF file of the report.',
+            'content': {
+                'application/pdf': {
+                    'schema': {
+                        'type': 'file'
+                    }
+                }
+            }
+        },
+        404: {
+            'description': 'Job not found or already expired.'
+        },
+        409: {
+            'description': 'Job is not finished yet.'
+        }
+    }
+})
+def job_download(user_id, job_id):
+    job = report_jobs.get(job_id, owner=user_id)
+    if not job:
+        return jsonify({'message': 'Job not found'}), 404
+    if job.status == FAILED:
+        return jsonify({'message': 'Report generation failed'}), 500
+    if job.status != DONE:
+        return jsonify({'message': f'Report is not ready yet, status: {job.status}'}), 409
+
+    return pdf_response(job.result, job.download_name)
+
+
+@reports_bp.route('/batch/monthly-events', methods=['GET'])
+@validate_token(admin_req=True)
+@swag_from({
+    'summary': 'Endpoint for downloading monthly events of all users (Admins).',
+    'description': 'Streams a ZIP archive with one monthly events PDF per user.',
+    'responses': {
+        200: {
+            'description': 'ZIP archive of monthly events PDFs.',
+            'content': {
+                'application/zip': {
+                    'schema': {
+                        'type': 'file'
+                    }
+                }
+            }
+        },
+        403: {
+            'description': 'Admin required.'
+        }
+    }
+})
+@read_only
+def batch_monthly_events(_):
+    since = get_first_day_of_month()
+    renderer_name = get_renderer().name
+    pool = get_batch_render_pool()
+    window = REPORT_BATCH_WORKERS * 2
+
+    def generate():
+        titles = EventTypeTitles()
+        stream = ZipStream()
+        archive = ZipFile(stream, 'w', compression=ZIP_STORED)
+        pending = deque()
+
+        def write_next():
+            name, future = pending.popleft()
+            try:
+                pdf = future.result()
+            except Exception as ex:
+                # one broken document must not truncate the archive for everyone else
+                logger.error(f'Batch report {name} failed: {ex}')
+                return b''
+            archive.writestr(name, pdf)
+            return stream.drain()
+
+        for (user_id, gmail), events in groupby(all_users_event_rows(since), key=lambda row: (row.user_id, row.gmail)):
+            rows = []
+            for event in events:
+                if event.start_date is None:
+                    continue
+                rows.append((titles.title(event.event_type_id), event.start_date, event.end_date))
+
+            pending.append((f'{user_id}-{gmail}-monthly-events.pdf',
+                            pool.submit(render_monthly_events, rows, renderer_name)))
+            # keep a bounded number of rendered documents in memory
+            if len(pending) >= window:
+                yield write_next()
+
+        while pending:
+            yield write_next()
+        archive.close()
+        yield stream.drain()
+
+    return Response(stream_with_context(iter_on_replica(generate())), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename=monthly-events-{since:%Y-%m}.zip'})
+
+
+@reports_bp.route('/export/monthly-events', methods=['GET'])
+@validate_token()
+@swag_from({
+    'summary': 'Endpoint for exporting events as CSV or NDJSON.',
+    'description': 'Streams the events of the authenticated user in a date range, one row per event.',
+    'parameters': EXPORT_PARAMETERS,
+    'responses': {
+        200: {
+            'description': 'Events as CSV or NDJSON.'
+        },
+        400: {
+            'description': 'Invalid format or date range.'
+        }
+    }
+})
+@read_only
+def export_monthly_events(user_id):
+    try:
+        since, until = parse_date_range(request.args)
+    except ValueError as ex:
+        return jsonify({'message': f'Invalid date range: {ex}'}), 400
+
+    def records():
+        titles = EventTypeTitles()
+        for event in stream_event_rows(user_id, since, until):
+            hours = (event.end_date - event.start_date).total_seconds() / 3600 if event.end_date else None
+            yield (event.id, event.event_type_id, titles.title(event.event_type_id),
+                   event.start_date.isoformat(), event.end_date.isoformat() if event.end_date else None, hours)
+
+    return export_response('events', ['id', 'event_type_id', 'event_type', 'start_date', 'end_date', 'hours'],
+                           records)
+
+
+@reports_bp.route('/export/grouped-monthly-events', methods=['GET'])
+@validate_token()
+@swag_from({
+    'summary': 'Endpoint for exporting hours per event type as CSV or NDJSON.',
+    'description': 'Streams total hours per event type of the authenticated user in a date range.',
+    'parameters': EXPORT_PARAMETERS,
+    'responses': {
+        200: {
+            'description': 'Hours per event type as CSV or NDJSON.'
+        },
+        400: {
+            'description': 'Invalid format or date range.'
+        }
+    }
+})
+@read_only
+def export_grouped_monthly_events(user_id):
+    try:
+        since, until = parse_date_range(request.args)
+    except ValueError as ex:
+        return jsonify({'message': f'Invalid date range: {ex}'}), 400
+
+    def records():
+        event_type_hours = hours_by_event_type(user_id, since, until)
+        titles = EventTypeTitles().covering(event_type_hours)
+        for et_id, title in sorted(titles.items()):
+            yield et_id, title, event_type_hours.get(et_id, .0)
+        for et_id, hours in event_type_hours.items():
+            if et_id not in titles:
+                yield et_id, UNKNOWN_EVENT_TYPE, hours
+
+    return export_response('grouped-events', ['event_type_id', 'event_type', 'hours'], records)
@@ -0,0 +1,2 @@
+"""WSGI entry point, served by gunicorn with the settings in gunicorn.conf.py."""
+from app import app